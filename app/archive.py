@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import logging
+import zlib
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import String, column, delete, literal, select, table, text
+from sqlalchemy.orm import Session
+from . import models, schemas, search, sharding
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+# Hot/cold tiering of messages. Messages older than ARCHIVE_AFTER_DAYS that
+# are neither public nor featured move from `messages` to `archived_messages`
+# in the same shard, with their content deflated. The hot table and its
+# indexes only hold recent messages; crud merges archived rows into the inbox
+# and sent listings so cursors walk past the hot window unchanged. Public and
+# favourite listings never include archived messages. Archived messages stay
+# in messages_fts, inbox search finds them without decompressing anything.
+#
+# Messages are short, so each one is deflated against a preset dictionary
+# sampled from the first archived batch of the shard instead of on its own.
+MAX_DICTIONARY_SIZE = 32 * 1024  # the most a deflate window can use
+
+
+def _untyped(model):
+    # rows copied as stored, sent_at keeps the text format the cursors compare with
+    return table(model.__tablename__, *[column(c.name) for c in model.__table__.columns])
+
+_messages = _untyped(models.Message)
+_archived_messages = _untyped(models.ArchivedMessage)
+
+# dictionaries never change once written, cached per database
+_dictionaries = {}
+
+
+def _get_dictionary(db: Session, dictionary_id: int) -> bytes:
+    key = (str(db.get_bind().url), dictionary_id)
+    data = _dictionaries.get(key)
+    if data is None:
+        data = _dictionaries[key] = db.get(models.ArchiveDictionary, dictionary_id).data
+    return data
+
+
+def _current_dictionary(db: Session, contents: list[str]) -> tuple[int, bytes]:
+    dictionary = db.query(models.ArchiveDictionary).order_by(models.ArchiveDictionary.id.desc()).first()
+    if dictionary is None:
+        # deflate prefers matches close to the end of the dictionary
+        sample = '\n'.join(contents).encode()[-MAX_DICTIONARY_SIZE:]
+        dictionary = models.ArchiveDictionary(data=sample)
+        db.add(dictionary)
+        db.flush()
+    return dictionary.id, dictionary.data
+
+
+def compress(content: str, dictionary: bytes) -> bytes:
+    compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=dictionary)
+    return compressor.compress((content or '').encode()) + compressor.flush()
+
+
+def decompress(data: bytes, dictionary: bytes) -> str:
+    decompressor = zlib.decompressobj(-15, zdict=dictionary)
+    return (decompressor.decompress(data) + decompressor.flush()).decode()
+
+
+# archived_messages columns selected by the listings, turned into
+# schemas.MessageRow by decode_rows
+ARCHIVED_COLUMNS = (
+    models.ArchivedMessage.id,
+    models.ArchivedMessage.content,
+    models.ArchivedMessage.dictionary_id,
+    models.ArchivedMessage.sender_id,
+    models.ArchivedMessage.receiver_id,
+    models.ArchivedMessage.is_anonymous,
+    models.ArchivedMessage.is_seen,
+    models.ArchivedMessage.sent_at,
+    models.ArchivedMessage.image,
+)
+
+def decode_rows(db: Session, rows: list) -> list[schemas.MessageRow]:
+    return [
+        schemas.MessageRow(
+            row.id, decompress(row.content, _get_dictionary(db, row.dictionary_id)),
+            row.sender_id, row.receiver_id, row.is_anonymous, False, False, row.is_seen, row.sent_at, image=row.image,
+        )
+        for row in rows
+    ]
+
+
+# queries too short for messages_fts only look this far into the archive
+MAX_SCANNED_ROWS = 5000
+
+
+def search_page(db: Session, query, q: str, limit: int, after=None) -> list[schemas.MessageRow]:
+    # for queries messages_fts can't answer: the (receiver scoped and ordered)
+    # query is decompressed and matched until a page is found, until it
+    # reaches rows listed after the row `after`, or for MAX_SCANNED_ROWS rows
+    q = q.casefold()
+    found = []
+    for row in query.limit(MAX_SCANNED_ROWS).execution_options(yield_per=500):
+        if after is not None and (row.sent_at, row.id) < (after.sent_at, after.id):
+            break
+        message = decode_rows(db, [row])[0]
+        if q in message.content.casefold():
+            found.append(message)
+            if len(found) == limit:
+                break
+    return found
+
+
+def archive_messages(db: Session, older_than: datetime, batch_size: int) -> int:
+    """Move up to batch_size messages sent before older_than to the archive, returns how many."""
+    cutoff = literal(older_than.strftime('%Y-%m-%d %H:%M:%S'), String)
+    rows = db.execute(
+        select(_messages)
+        .where(_messages.c.sent_at < cutoff, _messages.c.is_public == False, _messages.c.is_featured == False)
+        .order_by(_messages.c.id)
+        .limit(batch_size)
+    ).all()
+    if not rows:
+        return 0
+    dictionary_id, dictionary = _current_dictionary(db, [row.content or '' for row in rows])
+    db.execute(_archived_messages.insert(), [
+        {
+            'id': row.id,
+            'content': compress(row.content, dictionary),
+            'dictionary_id': dictionary_id,
+            'sender_id': row.sender_id,
+            'receiver_id': row.receiver_id,
+            'is_anonymous': row.is_anonymous,
+            'sent_at': row.sent_at,
+            'is_seen': row.is_seen,
+            'image': row.image,
+        }
+        for row in rows
+    ])
+    ids = [row.id for row in rows]
+    db.execute(delete(_messages).where(_messages.c.id.in_(ids)))
+    db.commit()
+    return len(rows)
+
+
+def restore_message(db: Session, message_id: int, receiver_id: int) -> bool:
+    """Move an archived message back to the hot table, e.g. before making it public."""
+    row = db.execute(
+        select(_archived_messages).where(_archived_messages.c.id == message_id, _archived_messages.c.receiver_id == receiver_id)
+    ).first()
+    if row is None:
+        return False
+    content = decompress(row.content, _get_dictionary(db, row.dictionary_id))
+    db.execute(_messages.insert().values(
+        id=row.id, content=content, sender_id=row.sender_id, receiver_id=row.receiver_id,
+        is_anonymous=row.is_anonymous, is_public=False, is_featured=False, sent_at=row.sent_at, is_seen=row.is_seen, image=row.image,
+    ))
+    db.execute(delete(_archived_messages).where(_archived_messages.c.id == message_id))
+    # its messages_fts row stays as it is
+    return True
+
+
+def unindex_archived_messages(db: Session, rows: list):
+    # rows with the id, content, dictionary_id and receiver_id of deleted archived messages
+    search.unindex_messages(db, [
+        models.Message(id=row.id, content=decompress(row.content, _get_dictionary(db, row.dictionary_id)), receiver_id=row.receiver_id)
+        for row in rows
+    ])
+
+
+def index_archived_messages(db: Session, batch_size: int = 500) -> int:
+    """Add the archived messages missing from messages_fts, e.g. after it was rebuilt, returns how many."""
+    if not search.is_supported(db.get_bind()):
+        return 0
+    query = (
+        select(_archived_messages)
+        .where(text('NOT EXISTS (SELECT 1 FROM messages_fts WHERE messages_fts.rowid = archived_messages.id)'))
+        .order_by(_archived_messages.c.id)
+        .limit(batch_size)
+    )
+    total = 0
+    # indexed rows no longer match
+    while rows := db.execute(query).all():
+        search.index_messages(db, [
+            models.Message(id=row.id, content=decompress(row.content, _get_dictionary(db, row.dictionary_id)), receiver_id=row.receiver_id)
+            for row in rows
+        ])
+        db.commit()
+        total += len(rows)
+    return total
+
+
+# Background job, moves old messages in small batches so a shard's writer
+# is never held for long. Each batch is one transaction, so the job can be
+# cancelled at any point.
+class Archiver:
+    def __init__(self, max_age_days: int, batch_size: int):
+        self.max_age_days = max_age_days
+        self.batch_size = batch_size
+
+    async def archive(self) -> int:
+        older_than = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=self.max_age_days)
+        total = 0
+        for shard in sharding.shards:
+            while True:
+                moved = await shard.run_write(archive_messages, older_than, self.batch_size)
+                total += moved
+                if moved < self.batch_size:
+                    break
+        return total
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                moved = await self.archive()
+                if moved:
+                    logger.info('Archived %d messages', moved)
+            except Exception:
+                logger.exception('Failed to archive messages')
+
+
+archiver = Archiver(get_settings().ARCHIVE_AFTER_DAYS, get_settings().ARCHIVE_BATCH_SIZE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move old messages to the compressed archive now.')
+    parser.add_argument('--days', type=int, default=archiver.max_age_days, help='archive messages older than this')
+    args = parser.parse_args()
+    print(f'{asyncio.run(Archiver(args.days, archiver.batch_size).archive())} messages archived')
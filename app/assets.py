@@ -0,0 +1,168 @@
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import jinja2
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+
+try:
+    import brotli
+except ImportError:  # optional, only .gz variants are built without it
+    brotli = None
+
+
+# Static assets. `python -m app.assets` copies every file of static/ to
+# static/dist/ under a name containing a hash of its content, writes
+# pre-compressed .gz (and .br) variants of the text files next to them and a
+# manifest mapping the source names to the built ones. Templates link assets
+# with static_url(), which uses the built name when there is one: those
+# files never change and are cached for good, a new build changes the URLs.
+#
+#   python -m app.assets
+
+STATIC_DIR = 'static'
+DIST_DIR = 'dist'
+MANIFEST = 'manifest.json'
+COMPRESSED_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+MIN_COMPRESS_SIZE = 256
+
+
+def _fingerprinted(name: str, data: bytes) -> str:
+    root, ext = os.path.splitext(name)
+    return f'{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+
+
+def _compressible(name: str, data: bytes) -> bool:
+    content_type = mimetypes.guess_type(name)[0] or ''
+    return content_type.startswith(COMPRESSED_TYPES) and len(data) >= MIN_COMPRESS_SIZE
+
+
+def build(static_dir: str = STATIC_DIR) -> dict[str, str]:
+    dist = os.path.join(static_dir, DIST_DIR)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        if os.path.abspath(root) == os.path.abspath(static_dir):
+            dirs[:] = [d for d in dirs if d != DIST_DIR]
+        for filename in sorted(files):
+            path = os.path.join(root, filename)
+            name = os.path.relpath(path, static_dir).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            built = _fingerprinted(name, data)
+            target = os.path.join(dist, built)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+            if _compressible(name, data):
+                # mtime 0: the same input always gives the same .gz
+                variants = [('.gz', gzip.compress(data, 9, mtime=0))]
+                if brotli is not None:
+                    variants.append(('.br', brotli.compress(data, quality=11)))
+                for suffix, compressed in variants:
+                    if len(compressed) < len(data):
+                        with open(target + suffix, 'wb') as f:
+                            f.write(compressed)
+            manifest[name] = f'{DIST_DIR}/{built}'
+    with open(os.path.join(dist, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_dir: str = STATIC_DIR) -> dict[str, str]:
+    try:
+        with open(os.path.join(static_dir, DIST_DIR, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        # not built, assets are served from their source names
+        return {}
+
+
+manifest = load_manifest()
+
+
+@jinja2.pass_context
+def static_url(context, name: str) -> str:
+    return str(context['request'].url_for('static', path=manifest.get(name, name)))
+
+
+def _accepted_encodings(accept_encoding: str) -> set[str]:
+    accepted = set()
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(coding.strip().lower())
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    # serves file.br or file.gz in place of file when the client accepts it,
+    # built files are cached as immutable
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._dist = os.path.join(os.path.realpath(self.directory), DIST_DIR, '') if self.directory else None
+        # full path -> encodings with a variant on disk, built files don't change
+        self._variants = {}
+
+    def _get_variants(self, full_path: str) -> list[tuple[str, str]]:
+        variants = self._variants.get(full_path)
+        if variants is None:
+            variants = self._variants[full_path] = [
+                (encoding, full_path + suffix) for encoding, suffix in (('br', '.br'), ('gzip', '.gz'))
+                if os.path.isfile(full_path + suffix)
+            ]
+        return variants
+
+    def file_response(self, full_path, stat_result, scope, status_code=200) -> Response:
+        request_headers = Headers(scope=scope)
+        immutable = self._dist is not None and str(full_path).startswith(self._dist)
+        variants = self._get_variants(str(full_path)) if immutable else []
+        if not variants:
+            response = super().file_response(full_path, stat_result, scope, status_code)
+        else:
+            accepted = _accepted_encodings(request_headers.get('accept-encoding', ''))
+            for encoding, path in variants:
+                if encoding in accepted:
+                    response = FileResponse(
+                        path, status_code=status_code, stat_result=os.stat(path),
+                        media_type=mimetypes.guess_type(str(full_path))[0] or 'text/plain',
+                        headers={'content-encoding': encoding},
+                    )
+                    if self.is_not_modified(response.headers, request_headers):
+                        response = NotModifiedResponse(response.headers)
+                    break
+            else:
+                response = super().file_response(full_path, stat_result, scope, status_code)
+            response.headers['vary'] = 'Accept-Encoding'
+        if immutable:
+            response.headers['cache-control'] = 'public, max-age=31536000, immutable'
+        return response
+
+
+class CompressionMiddleware(GZipMiddleware):
+    # gzips dynamic responses above minimum_size; static files come
+    # pre-compressed and media (images, byte ranges) are left alone
+    def __init__(self, app, minimum_size: int = 500, excluded_paths: tuple[str, ...] = ()):
+        super().__init__(app, minimum_size=minimum_size)
+        self.excluded_paths = excluded_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['path'].startswith(self.excluded_paths):
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fingerprint and pre-compress the static assets.')
+    parser.add_argument('--static-dir', default=STATIC_DIR)
+    args = parser.parse_args()
+    built = build(args.static_dir)
+    print(f"{len(built)} assets built{'' if brotli else ', without brotli (pip install Brotli)'}")
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+from .config import get_settings
+
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries also expire after a time-to-live."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl: float | None = None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def pop_matching(self, predicate) -> int:
+        # scans every entry, for rare invalidations only
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                del self._data[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+# Authenticated user caches: verified JWT claims by token and user snapshots
+# by user id, so a session that hasn't changed costs no decode and no query.
+_settings = get_settings()
+token_cache = TTLCache(_settings.AUTH_CACHE_SIZE, _settings.AUTH_CACHE_TTL)
+user_cache = TTLCache(_settings.AUTH_CACHE_SIZE, _settings.AUTH_CACHE_TTL)
+
+
+def invalidate_user(user_id: int):
+    # cached tokens of this user are checked against the fresh snapshot's email
+    user_cache.pop(user_id)
+
+
+# Rendered message cards, keyed by everything a card shows (see
+# main.message_card): an edited message gets a new entry and the old one is
+# evicted eventually. Deleted messages' cards are dropped at once.
+message_card_cache = TTLCache(_settings.MESSAGE_CARD_CACHE_SIZE, _settings.MESSAGE_CARD_CACHE_TTL)
+
+
+def invalidate_message_cards(message_ids: list[int]):
+    message_ids = set(message_ids)
+    message_card_cache.pop_matching(lambda key: key[1] in message_ids)
+
+
+# Rendered public profile pages keyed by (user id, wall version, JSON or not,
+# base URL). Anything that changes what a wall shows bumps its version, so
+# stale pages are never served and are simply left to expire.
+public_page_cache = TTLCache(_settings.PUBLIC_PAGE_CACHE_SIZE, _settings.PUBLIC_PAGE_CACHE_TTL)
+_wall_versions = {}
+_wall_versions_lock = threading.Lock()
+
+
+def wall_version(user_id: int) -> int:
+    return _wall_versions.get(user_id, 0)
+
+
+def invalidate_wall(user_id: int):
+    with _wall_versions_lock:
+        _wall_versions[user_id] = _wall_versions.get(user_id, 0) + 1
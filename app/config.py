@@ -1,3 +1,4 @@
+from functools import lru_cache
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -9,7 +10,115 @@ class Settings(BaseSettings):
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 60
     REFRESH_TOKEN_EXPIRE_MINUTES: int = 60
     API_VERSION: str = '/api/v1'
+    MESSAGES_PAGE_SIZE: int = 20
+    USERS_PAGE_SIZE: int = 20
+    # messages fetched and written per chunk by the NDJSON inbox export
+    EXPORT_CHUNK_SIZE: int = 1000
+    # max number of threads running blocking database calls for async endpoints
+    DB_THREADPOOL_SIZE: int = 8
+    # SQLite storage profile, see database.py
+    DB_READ_POOL_SIZE: int = 8
+    SQLITE_JOURNAL_MODE: str = 'WAL'
+    SQLITE_SYNCHRONOUS: str = 'NORMAL'
+    SQLITE_CACHE_SIZE: int = -64000  # negative values are KiB
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_BUSY_TIMEOUT: int = 5000  # ms
+    # message shards (see sharding.py): database URLs, a user's messages live in
+    # MESSAGE_SHARDS[user_id % len(MESSAGE_SHARDS)]. Empty keeps them in DATABASE_URL.
+    # Changing the list requires moving the messages, see split_messages.py
+    MESSAGE_SHARDS: list[str] = []
+    # bcrypt runs on its own threads: at most WORKERS hashes at once and
+    # QUEUE_SIZE waiting, anything beyond that is rejected with a 503
+    PASSWORD_HASH_WORKERS: int = 2
+    PASSWORD_HASH_QUEUE_SIZE: int = 16
+    # verified tokens and authenticated user snapshots
+    AUTH_CACHE_SIZE: int = 10000
+    AUTH_CACHE_TTL: int = 60
+    # rendered public profile pages, also the longest a page's visitors count can lag
+    PUBLIC_PAGE_CACHE_SIZE: int = 1000
+    PUBLIC_PAGE_CACHE_TTL: int = 30
+    # compiled templates, None uses a directory in the system temp dir
+    TEMPLATE_CACHE_DIR: str | None = None
+    # check templates for changes on every use, off in production
+    TEMPLATE_AUTO_RELOAD: bool = True
+    MESSAGE_CARD_CACHE_SIZE: int = 10000
+    MESSAGE_CARD_CACHE_TTL: int = 3600
+    # profile views are buffered in memory and written every FLUSH_INTERVAL
+    # seconds, or sooner once MAX_PENDING views are waiting
+    VISITORS_FLUSH_INTERVAL: float = 5
+    VISITORS_MAX_PENDING: int = 1000
+    # messages older than ARCHIVE_AFTER_DAYS, neither public nor featured, are
+    # moved to the compressed archive every ARCHIVE_INTERVAL seconds (0 days disables)
+    ARCHIVE_AFTER_DAYS: int = 365
+    ARCHIVE_INTERVAL: float = 3600
+    ARCHIVE_BATCH_SIZE: int = 500
+    # dynamic responses smaller than this are sent uncompressed
+    GZIP_MIN_SIZE: int = 500
+    # posts per second (and bursts) allowed per client IP, receiver and logged
+    # in sender, 0 disables a limit; see ratelimit.py
+    MESSAGE_RATE_PER_IP: float = 0.2
+    MESSAGE_BURST_PER_IP: int = 10
+    MESSAGE_RATE_PER_RECEIVER: float = 2
+    MESSAGE_BURST_PER_RECEIVER: int = 30
+    MESSAGE_RATE_PER_SENDER: float = 0.5
+    MESSAGE_BURST_PER_SENDER: int = 20
+    RATE_LIMIT_TABLE_SIZE: int = 100000
+    # write requests in flight, more are answered 503 at once
+    WRITE_CONCURRENCY: int = 32
+    # new message digests, see notifications.py: NOTIFICATION_SINK is '' (no
+    # notifications), 'file' (JSON lines appended to NOTIFICATION_FILE) or
+    # 'smtp'. Pending notifications are sent every NOTIFICATION_INTERVAL seconds
+    NOTIFICATION_SINK: str = ''
+    NOTIFICATION_INTERVAL: float = 300
+    NOTIFICATION_BATCH_SIZE: int = 500
+    NOTIFICATION_FILE: str = './notifications.log'
+    NOTIFICATION_FROM: str = 'whisper@localhost'
+    # site address for the links in digests
+    NOTIFICATION_BASE_URL: str = ''
+    SMTP_HOST: str = 'localhost'
+    SMTP_PORT: int = 25
+    SMTP_USERNAME: str = ''
+    SMTP_PASSWORD: str = ''
+    SMTP_STARTTLS: bool = False
+    # near-duplicate messages, see spam.py: 'reject' them, 'flag' (log) them
+    # or 'off'. A message is a near-duplicate when its estimated similarity
+    # to a recent one is at least SPAM_SIMILARITY; it is spam when
+    # SPAM_RECEIVER_DUPLICATES were sent to its receiver by the same sender,
+    # or when they were sent to SPAM_GLOBAL_RECEIVERS receivers, among the
+    # last SPAM_INDEX_SIZE messages of the last SPAM_WINDOW_SECONDS.
+    # Flagged only until the thresholds are tuned on real traffic
+    SPAM_ACTION: str = 'flag'
+    SPAM_SIMILARITY: float = 0.8
+    SPAM_RECEIVER_DUPLICATES: int = 2
+    SPAM_GLOBAL_RECEIVERS: int = 5
+    SPAM_INDEX_SIZE: int = 20000
+    SPAM_WINDOW_SECONDS: float = 3600
+    SPAM_INDEX_PATH: str = './spam_index.pickle'
+    # requests slower than this are logged with the SQL they ran (0 disables)
+    SLOW_REQUEST_SECONDS: float = 0
+    # /metrics is served to scrapers sending "Authorization: Bearer <METRICS_TOKEN>", and not at all if unset
+    METRICS_TOKEN: str = ''
+    # undelivered real-time messages kept per connected client
+    PUBSUB_QUEUE_SIZE: int = 100
+    # uploaded images, see media.py
+    MEDIA_ROOT: str = './media'
+    # uploads in progress, on the same file system as MEDIA_ROOT (they are renamed into it)
+    MEDIA_TMP_DIR: str = './media_tmp'
+    MEDIA_MAX_UPLOAD_SIZE: int = 10 * 1024 * 1024
+    MEDIA_WORKERS: int = 2
+    MEDIA_THUMBNAIL_SIZE: int = 640
+    MEDIA_AVATAR_SIZE: int = 256
+    # commit posted messages in groups: a batch is written once it has
+    # MAX_BATCH messages or its first message waited MAX_DELAY seconds
+    MESSAGE_GROUP_COMMIT: bool = False
+    MESSAGE_GROUP_COMMIT_MAX_BATCH: int = 200
+    MESSAGE_GROUP_COMMIT_MAX_DELAY: float = 0.005
 
     # the modern way to read configuration file instead of the inner class Config, see:
     # https://fastapi.tiangolo.com/advanced/settings/#the-env-file
     model_config = SettingsConfigDict(env_file=".env")
+
+
+@lru_cache
+def get_settings():
+    return Settings()
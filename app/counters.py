@@ -0,0 +1,76 @@
+import asyncio
+import logging
+import threading
+from collections import Counter
+from . import crud
+from .config import get_settings
+from .database import run_write
+
+logger = logging.getLogger(__name__)
+
+
+# Write-behind buffer for profile visitor counters. Views are coalesced per
+# user in memory and written as `num_of_visitors = num_of_visitors + n`
+# batches, so a busy profile costs one write per flush instead of one per
+# view. At most one flush interval (or max_pending views) can be lost if the
+# process dies without shutting down.
+class VisitorCounter:
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self._pending = Counter()
+        self._flushing = Counter()
+        self._lock = threading.Lock()
+        self._wakeup = None
+        self._stopping = False
+
+    def increment(self, user_id: int):
+        with self._lock:
+            self._pending[user_id] += 1
+            total = self._pending.total()
+        if total >= self.max_pending and self._wakeup is not None:
+            self._wakeup.set()
+
+    def pending(self, user_id: int) -> int:
+        # views not written yet, added to the stored count when displaying it
+        with self._lock:
+            return self._pending[user_id] + self._flushing[user_id]
+
+    async def flush(self) -> int:
+        with self._lock:
+            batch, self._pending = self._pending, Counter()
+            self._flushing = batch
+        if not batch:
+            return 0
+        try:
+            await run_write(crud.add_user_visitors, dict(batch))
+        except Exception:
+            with self._lock:
+                self._pending.update(batch)
+            raise
+        finally:
+            with self._lock:
+                self._flushing = Counter()
+        return batch.total()
+
+    async def run(self, interval: float):
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Failed to flush visitor counters')
+
+    async def stop(self):
+        # lets an in-flight flush finish (cancelling it could lose its batch),
+        # run() then returns after flushing what is pending
+        self._stopping = True
+        self._wakeup.set()
+
+
+visitor_counter = VisitorCounter(get_settings().VISITORS_MAX_PENDING)
@@ -1,6 +1,10 @@
+import heapq
+from collections import Counter
+from datetime import datetime
+from itertools import islice
 from sqlalchemy.orm import Session
-from sqlalchemy import or_
-from . import models, schemas, utils
+from sqlalchemy import String, delete, func, insert, literal, or_, select, tuple_, union_all, update
+from . import archive, cache, models, notifications, schemas, search, sharding, utils
 
 
 def get_user(db: Session, user_id: int):
@@ -13,6 +17,11 @@ def get_users(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.User).offset(skip).limit(limit).all()
 
 def search_users(q: str, db: Session, skip: int = 0, limit: int = 100):
+    if search.is_supported(db.get_bind()):
+        ids = search.search_user_ids(db, q, skip, limit)
+        users = {u.id: u for u in db.query(models.User).filter(models.User.id.in_(ids))}
+        # keep the search index ranking
+        return [users[id] for id in ids if id in users]
     return (
         db.query(models.User)
         .filter(models.User.appear_in_search_results==True)
@@ -27,10 +36,13 @@ def search_users(q: str, db: Session, skip: int = 0, limit: int = 100):
         .all()
     )
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = utils.get_password_hash(user.password)
+def create_user(db: Session, user: schemas.UserCreate, hashed_password: str | None = None):
+    if hashed_password is None:
+        hashed_password = utils.get_password_hash(user.password)
     db_user = models.User(email=user.email, hashed_password=hashed_password, name=user.name)
     db.add(db_user)
+    db.flush()
+    search.index_user(db, db_user)
     db.commit()
     db.refresh(db_user)
     return db_user
@@ -45,8 +57,11 @@ def update_user_info(db: Session, user_id: int, info: schemas.UserInfo):
         user.bio = info.bio
     if info.gender and user.gender != info.gender:
         user.gender = info.gender
+    search.index_user(db, user)
     db.commit()
     db.refresh(user)
+    cache.invalidate_user(user_id)
+    cache.invalidate_wall(user_id)
     return user
 
 def update_user_privacy_settings(db: Session, user_id: int, settings: schemas.PrivacySettings):
@@ -58,45 +73,303 @@ def update_user_privacy_settings(db: Session, user_id: int, settings: schemas.Pr
     user.hide_visitors_count = settings.hide_visitors_count
     user.hide_last_seen = settings.hide_last_seen
     user.appear_in_search_results = settings.appear_in_search_results
+    search.index_user(db, user)
     db.commit()
     db.refresh(user)
+    cache.invalidate_user(user_id)
+    cache.invalidate_wall(user_id)
     return user
 
+def update_user_avatar(db: Session, user_id: int, avatar: str):
+    db.query(models.User).filter(models.User.id == user_id).update({models.User.avatar: avatar}, synchronize_session=False)
+    db.commit()
+    cache.invalidate_user(user_id)
+    cache.invalidate_wall(user_id)
+
 def increase_user_visitors(db: Session, user_id: int):
-    user = get_user(db, user_id)
-    user.num_of_visitors = user.num_of_visitors + 1
+    add_user_visitors(db, {user_id: 1})
+    return get_user(db, user_id)
+
+def add_user_visitors(db: Session, visitors: dict[int, int]):
+    # atomic increments, a batch of profile views costs a single transaction
+    for user_id, count in visitors.items():
+        db.execute(
+            update(models.User)
+            .where(models.User.id == user_id)
+            .values(num_of_visitors=func.coalesce(models.User.num_of_visitors, 0) + count)
+        )
     db.commit()
-    db.refresh(user)
-    return user
 
+# Message functions taking a writer session expect one on the receiver's
+# shard (see sharding.run_write). The ones reading take the request session
+# and query the receiver's shard themselves.
 def set_user_messages_seen(db: Session, user_id: int):
-    db.query(models.Message).filter(models.Message.receiver_id == user_id, models.Message.is_seen == False).update({models.Message.is_seen: True}, synchronize_session=False)
+    summary = db.get(models.InboxSummary, user_id)
+    if summary is None or not summary.unread_count:
+        # nothing unread, don't open a write transaction
+        return False
+    for model in (models.Message, models.ArchivedMessage):
+        db.query(model).filter(model.receiver_id == user_id, model.is_seen == False).update({model.is_seen: True}, synchronize_session=False)
+    summary.unread_count = 0
     db.commit()
     return True
 
+def get_inbox_summary(db: Session, user_id: int):
+    with sharding.for_user(user_id).session(db) as shard_db:
+        return shard_db.get(models.InboxSummary, user_id)
 
-def get_sent_messages(db: Session, user_id, skip: int = 0, limit: int = 100):
-    return db.query(models.Message).filter(
-        models.Message.sender_id == user_id
-    ).offset(skip).limit(limit).join(models.User)
+def _add_to_inbox_summaries(db: Session, messages: list[models.Message]):
+    for receiver_id, count in Counter(m.receiver_id for m in messages).items():
+        updated = db.execute(
+            update(models.InboxSummary)
+            .where(models.InboxSummary.user_id == receiver_id)
+            .values(
+                unread_count=models.InboxSummary.unread_count + count,
+                total_count=models.InboxSummary.total_count + count,
+                last_message_at=func.now(),
+            )
+        ).rowcount
+        if not updated:
+            db.add(models.InboxSummary(user_id=receiver_id, unread_count=count, total_count=count, last_message_at=func.now()))
+
+def rebuild_inbox_summaries(db: Session):
+    db.query(models.InboxSummary).delete()
+    messages = union_all(*[
+        select(model.receiver_id, model.is_seen, model.sent_at)
+        for model in (models.Message, models.ArchivedMessage)
+    ]).subquery()
+    db.execute(insert(models.InboxSummary).from_select(
+        ['user_id', 'unread_count', 'total_count', 'last_message_at'],
+        select(
+            messages.c.receiver_id,
+            func.count().filter(messages.c.is_seen == False),
+            func.count(),
+            func.max(messages.c.sent_at),
+        ).group_by(messages.c.receiver_id)
+    ))
+    db.commit()
 
-def get_messages(db: Session, filters: dict, skip: int = 0, limit: int = 100):
-    return db.query(models.Message).filter_by(**filters).order_by(models.Message.sent_at.desc()).offset(skip).limit(limit).all()
 
-def get_fav_messages(db: Session, user_id: int, skip: int = 0, limit: int = 100):
+def _sent_at_literal(sent_at: datetime):
+    # sent_at is filled by CURRENT_TIMESTAMP ('YYYY-MM-DD HH:MM:SS'), compare with
+    # the same text or rows sharing a second are repeated across pages
+    value = sent_at.strftime('%Y-%m-%d %H:%M:%S')
+    if sent_at.microsecond:
+        value += f'.{sent_at.microsecond:06d}'
+    return literal(value, String)
+
+def _paginate(query, cursor: str | None, limit: int | None, model=models.Message):
+    query = query.order_by(model.sent_at.desc(), model.id.desc())
+    if cursor:
+        sent_at, message_id = utils.decode_cursor(cursor)
+        query = query.filter(
+            tuple_(model.sent_at, model.id) < tuple_(_sent_at_literal(sent_at), message_id)
+        )
+    return query.limit(limit)
+
+def _merge(pages: list[list], limit: int) -> list:
+    # pages from the hot table, the archive or other shards, each in listing order
+    return list(islice(heapq.merge(*pages, key=lambda row: (row.sent_at, row.id), reverse=True), limit))
+
+def _page(db: Session, filters: dict, cursor: str | None, limit: int) -> list:
+    rows = _paginate(db.query(*MESSAGE_COLUMNS).filter_by(**filters), cursor, limit).all()
+    if filters.get('is_public') or filters.get('is_featured'):
+        # never archived
+        return rows
+    # older messages may be archived, the archive is paged alongside and merged
+    filters = {key: value for key, value in filters.items() if key not in ('is_public', 'is_featured')}
+    query = db.query(*archive.ARCHIVED_COLUMNS).filter_by(**filters)
+    archived = archive.decode_rows(db, _paginate(query, cursor, limit, models.ArchivedMessage).all())
+    return _merge([rows, archived], limit) if archived else rows
+
+
+# Listings select plain columns into schemas.MessageRow tuples: no ORM
+# identity map, no lazy loading. Sender and receiver names are then fetched
+# with one extra query for the whole page.
+MESSAGE_COLUMNS = (
+    models.Message.id,
+    models.Message.content,
+    models.Message.sender_id,
+    models.Message.receiver_id,
+    models.Message.is_anonymous,
+    models.Message.is_public,
+    models.Message.is_featured,
+    models.Message.is_seen,
+    models.Message.sent_at,
+    models.Message.image,
+)
+
+def _message_rows(db: Session, rows: list) -> list[schemas.MessageRow]:
+    user_ids = {row.receiver_id for row in rows}
+    user_ids.update(row.sender_id for row in rows if row.sender_id and not row.is_anonymous)
+    names = dict(db.query(models.User.id, models.User.name).filter(models.User.id.in_(user_ids))) if rows else {}
+    return [
+        schemas.MessageRow(
+            row.id, row.content,
+            # anonymous senders are never exposed
+            None if row.is_anonymous else row.sender_id,
+            row.receiver_id, row.is_anonymous, row.is_public, row.is_featured, row.is_seen, row.sent_at,
+            sender_name=None if row.is_anonymous else names.get(row.sender_id),
+            receiver_name=names.get(row.receiver_id),
+            image=row.image,
+        )
+        for row in rows
+    ]
+
+
+def get_sent_messages(db: Session, user_id: int, cursor: str | None = None, limit: int = 100):
+    # sent messages are spread over every shard: each one returns its own
+    # first page after the cursor and the pages are merged on (sent_at, id)
+    pages = []
+    for shard in sharding.shards:
+        with shard.session(db) as shard_db:
+            pages.append(_page(shard_db, {'sender_id': user_id}, cursor, limit))
+    return _message_rows(db, _merge(pages, limit))
+
+def get_messages(db: Session, filters: dict, cursor: str | None = None, limit: int = 100):
+    # filters always hold the receiver_id, which picks the shard
+    with sharding.for_user(filters['receiver_id']).session(db) as shard_db:
+        rows = _page(shard_db, filters, cursor, limit)
+    return _message_rows(db, rows)
+
+def get_fav_messages(db: Session, user_id: int, cursor: str | None = None, limit: int = 100):
     filters = {'receiver_id': user_id, 'is_featured': True}
-    return get_messages(db, filters)
+    return get_messages(db, filters, cursor, limit)
 
-def get_public_messages(db: Session, user_id: int, skip: int = 0, limit: int = 100):
+def get_public_messages(db: Session, user_id: int, cursor: str | None = None, limit: int = 100):
     filters = {'receiver_id': user_id, 'is_public': True}
-    return get_messages(db, filters)
+    return get_messages(db, filters, cursor, limit)
+
+def search_messages(db: Session, user_id: int, q: str, cursor: str | None = None, limit: int = 100):
+    with sharding.for_user(user_id).session(db) as shard_db:
+        query = shard_db.query(*MESSAGE_COLUMNS).filter(
+            models.Message.receiver_id == user_id,
+            search.message_search_filter(shard_db, user_id, q),
+        )
+        rows = _paginate(query, cursor, limit).all()
+        query = shard_db.query(*archive.ARCHIVED_COLUMNS).filter(models.ArchivedMessage.receiver_id == user_id)
+        if search.is_indexed_query(shard_db, q):
+            query = query.filter(search.message_search_filter(shard_db, user_id, q, models.ArchivedMessage))
+            archived = archive.decode_rows(shard_db, _paginate(query, cursor, limit, models.ArchivedMessage).all())
+        else:
+            # a full page from the hot table bounds how far the archive is scanned
+            after = rows[-1] if len(rows) == limit else None
+            archived = archive.search_page(shard_db, _paginate(query, cursor, None, models.ArchivedMessage), q, limit, after)
+    return _message_rows(db, _merge([rows, archived], limit))
+
+def iter_received_messages(db: Session, user_id: int, chunk_size: int = 1000):
+    # the whole inbox, hot and archived, newest first, in chunks of rows: the
+    # cursors are read with yield_per so memory doesn't grow with the inbox
+    with sharding.for_user(user_id).session(db) as shard_db:
+        hot = shard_db.query(*MESSAGE_COLUMNS).filter(models.Message.receiver_id == user_id)
+        hot = _paginate(hot, None, None).execution_options(yield_per=chunk_size)
+        archived = shard_db.query(*archive.ARCHIVED_COLUMNS).filter(models.ArchivedMessage.receiver_id == user_id)
+        archived = _paginate(archived, None, None, models.ArchivedMessage).execution_options(yield_per=chunk_size)
+        rows = heapq.merge(
+            hot, (archive.decode_rows(shard_db, [row])[0] for row in archived),
+            key=lambda row: (row.sent_at, row.id), reverse=True,
+        )
+        while chunk := list(islice(rows, chunk_size)):
+            yield _message_rows(db, chunk)
+
+def get_message_by_id(db: Session, message_id: int, receiver_id: int):
+    with sharding.for_user(receiver_id).session(db) as shard_db:
+        for model in (models.Message, models.ArchivedMessage):
+            message = shard_db.query(model).filter(model.id == message_id, model.receiver_id == receiver_id).first()
+            if message:
+                return message
+
+def get_messages_by_ids(db: Session, receiver_id: int, message_ids: list[int]):
+    with sharding.for_user(receiver_id).session(db) as shard_db:
+        rows = shard_db.query(*MESSAGE_COLUMNS).filter(models.Message.id.in_(message_ids), models.Message.receiver_id == receiver_id).all()
+        archived = shard_db.query(*archive.ARCHIVED_COLUMNS).filter(
+            models.ArchivedMessage.id.in_(message_ids), models.ArchivedMessage.receiver_id == receiver_id
+        ).all()
+        rows += archive.decode_rows(shard_db, archived)
+    return _message_rows(db, sorted(rows, key=lambda row: (row.sent_at, row.id), reverse=True))
 
-def get_message_by_id(db: Session, message_id: int):
-    return db.query(models.Message).filter(models.Message.id == message_id).first()
+def update_message_flags(db: Session, message_id: int, receiver_id: int, flags: dict):
+    # ownership is part of the WHERE clause, other users' messages are never touched
+    query = db.query(models.Message).filter(models.Message.id == message_id, models.Message.receiver_id == receiver_id)
+    updated = query.update(flags, synchronize_session=False)
+    if not updated and any(flags.values()) and archive.restore_message(db, message_id, receiver_id):
+        # archived messages are private and not featured, they go back to the
+        # hot table when that changes
+        updated = query.update(flags, synchronize_session=False)
+    db.commit()
+    return bool(updated)
+
+MODERATION_FLAGS = {
+    'publish': {'is_public': True},
+    'hide': {'is_public': False},
+    'feature': {'is_featured': True},
+    'unfeature': {'is_featured': False},
+}
+
+def moderate_messages(db: Session, receiver_id: int, message_ids: list[int], action: str) -> list[int]:
+    # a single transaction for the whole batch, ownership is part of every
+    # WHERE clause so other users' ids are silently skipped
+    message_ids = list(set(message_ids))
+    owned = lambda model: (model.id.in_(message_ids), model.receiver_id == receiver_id)
+    if action == 'delete':
+        deleted = db.execute(
+            delete(models.Message).where(*owned(models.Message))
+            .returning(models.Message.id, models.Message.is_seen, models.Message.content, models.Message.receiver_id)
+        ).all()
+        search.unindex_messages(db, deleted)
+        archived = db.execute(
+            delete(models.ArchivedMessage).where(*owned(models.ArchivedMessage)).returning(
+                models.ArchivedMessage.id, models.ArchivedMessage.is_seen, models.ArchivedMessage.content,
+                models.ArchivedMessage.dictionary_id, models.ArchivedMessage.receiver_id,
+            )
+        ).all()
+        archive.unindex_archived_messages(db, archived)
+        deleted += archived
+        if deleted:
+            db.execute(
+                update(models.InboxSummary)
+                .where(models.InboxSummary.user_id == receiver_id)
+                .values(
+                    unread_count=models.InboxSummary.unread_count - sum(not row.is_seen for row in deleted),
+                    total_count=models.InboxSummary.total_count - len(deleted),
+                )
+            )
+        db.commit()
+        cache.invalidate_message_cards([row.id for row in deleted])
+        return [row.id for row in deleted]
+
+    flags = MODERATION_FLAGS[action]
+    archived = db.scalars(select(models.ArchivedMessage.id).where(*owned(models.ArchivedMessage))).all()
+    if any(flags.values()):
+        # archived messages are private and not featured, they go back to the
+        # hot table when that changes
+        for message_id in archived:
+            archive.restore_message(db, message_id, receiver_id)
+        archived = []
+    updated = db.scalars(update(models.Message).where(*owned(models.Message)).values(flags).returning(models.Message.id)).all()
+    db.commit()
+    return updated + archived
 
 def create_message(db: Session, message: schemas.MessageCreate):
     db_message = models.Message(**message.dict())
     db.add(db_message)
+    db.flush()
+    search.index_messages(db, [db_message])
+    _add_to_inbox_summaries(db, [db_message])
+    notifications.add_events(db, [db_message])
     db.commit()
     db.refresh(db_message)
     return db_message
+
+def create_messages(db: Session, messages: list[schemas.MessageCreate]):
+    db_messages = [models.Message(**message.dict()) for message in messages]
+    db.add_all(db_messages)
+    db.flush()
+    ids = [m.id for m in db_messages]
+    search.index_messages(db, db_messages)
+    _add_to_inbox_summaries(db, db_messages)
+    notifications.add_events(db, db_messages)
+    db.commit()
+    # a single query reloads the server defaults (sent_at) of the whole batch
+    db.query(models.Message).filter(models.Message.id.in_(ids)).all()
+    return db_messages
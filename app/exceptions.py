@@ -1,2 +1,36 @@
 class RequiresLogin(Exception):
     pass
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class WritesBusy(Exception):
+    pass
+
+
+class SpamDetected(Exception):
+    pass
+
+
+class ImageWorkersFailed(Exception):
+    pass
+
+
+class InvalidUpload(ValueError):
+    pass
+
+
+class UploadTooLarge(InvalidUpload):
+    pass
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import metrics, utils
+from .config import get_settings
+from .exceptions import PasswordHasherBusy
+
+
+# bcrypt costs ~250ms of CPU per call. It releases the GIL while hashing, so a
+# small dedicated thread pool keeps it off the event loop (and off the
+# database pool) without the pickling overhead of a process pool.
+class PasswordHasher:
+    def __init__(self, workers: int, queue_size: int):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hasher')
+        self.max_pending = workers + queue_size
+        # only touched from the event loop thread
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.hash_seconds_total = 0.0
+
+    async def _run(self, operation: str, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy()
+        self.pending += 1
+        queued_at = time.perf_counter()
+
+        def job():
+            started_at = time.perf_counter()
+            result = func(*args)
+            return result, started_at - queued_at, time.perf_counter() - started_at
+
+        try:
+            loop = asyncio.get_running_loop()
+            result, wait, duration = await loop.run_in_executor(self._executor, job)
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.wait_seconds_total += wait
+        self.wait_seconds_max = max(self.wait_seconds_max, wait)
+        self.hash_seconds_total += duration
+        metrics.password_hash_wait.observe(wait)
+        metrics.password_hash_duration.observe(duration, operation)
+        return result
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run('verify', utils.verify_password, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        return await self._run('hash', utils.get_password_hash, password)
+
+    def stats(self) -> dict:
+        return {
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'wait_seconds_total': self.wait_seconds_total,
+            'wait_seconds_max': self.wait_seconds_max,
+            'hash_seconds_total': self.hash_seconds_total,
+        }
+
+
+password_hasher = PasswordHasher(
+    get_settings().PASSWORD_HASH_WORKERS,
+    get_settings().PASSWORD_HASH_QUEUE_SIZE,
+)
@@ -1,37 +1,133 @@
-from functools import lru_cache
+import asyncio
+import anyio
+import hashlib
+import hmac
+import jinja2
+import orjson
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta, timezone
 from typing import Annotated, Optional
-from fastapi import Depends, FastAPI, Form, HTTPException, status, Request
+from fastapi import Depends, FastAPI, Form, HTTPException, status, Request, WebSocket, WebSocketDisconnect
 from sqlalchemy import desc
 from sqlalchemy.orm import Session
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from fastapi.responses import HTMLResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, ORJSONResponse, PlainTextResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
-from urllib.parse import quote
-from . import crud, models, schemas, config
-from .database import SessionLocal, engine
-from .utils import verify_password
-from .exceptions import RequiresLogin
+from urllib.parse import quote, urlsplit
+from markupsafe import Markup
+from . import assets, cache, crud, metrics, migrations, models, ratelimit, schemas, config, sharding
+from .archive import archiver
+from .config import get_settings
+from .counters import visitor_counter
+from .database import ReadSessionLocal, run_db, run_write
+from .hashing import password_hasher
+from .media import MediaFiles, media_path, media_store, resized_name
+from .notifications import digest_worker
+from .pubsub import broker
+from .spam import spam_index, warm_up as warm_up_spam_index
+from .utils import etag_matches, next_cursor
+from .writer import message_writer
+from .exceptions import ImageWorkersFailed, InvalidCursor, InvalidUpload, PasswordHasherBusy, RateLimited, RequiresLogin, SpamDetected, UploadTooLarge, WritesBusy
 
 
-@lru_cache
-def get_settings():
-    return config.Settings()
-
 settings = get_settings()
-# print('settings =', settings.json())
 SECRET_KEY = settings.JWT_PRIVATE_KEY
 ALGORITHM = settings.JWT_ALGORITHM
 ACCESS_TOKEN_EXPIRE_MINUTES = settings.ACCESS_TOKEN_EXPIRE_MINUTES
 API_VERSION = settings.API_VERSION
-
-models.Base.metadata.create_all(bind=engine)
-app = FastAPI()
+PAGE_SIZE = settings.MESSAGES_PAGE_SIZE
+
+migrations.upgrade_all()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # compiled (or loaded from the bytecode cache) before the first request
+    for name in templates.env.list_templates():
+        templates.get_template(name)
+    if settings.SPAM_ACTION != 'off':
+        await anyio.to_thread.run_sync(warm_up_spam_index, spam_index, settings.SPAM_INDEX_PATH)
+    visitors_flusher = asyncio.create_task(visitor_counter.run(settings.VISITORS_FLUSH_INTERVAL))
+    if settings.MESSAGE_GROUP_COMMIT:
+        messages_writer = asyncio.create_task(message_writer.run())
+    if settings.ARCHIVE_AFTER_DAYS:
+        messages_archiver = asyncio.create_task(archiver.run(settings.ARCHIVE_INTERVAL))
+    if settings.NOTIFICATION_SINK:
+        notifier = asyncio.create_task(digest_worker.run(settings.NOTIFICATION_INTERVAL))
+    yield
+    if settings.NOTIFICATION_SINK:
+        notifier.cancel()
+    if settings.ARCHIVE_AFTER_DAYS:
+        messages_archiver.cancel()
+    if settings.MESSAGE_GROUP_COMMIT:
+        await message_writer.stop()
+        await messages_writer
+    await visitor_counter.stop()
+    await visitors_flusher
+    await visitor_counter.flush()
+    await media_store.close()
+    if settings.SPAM_ACTION != 'off' and settings.SPAM_INDEX_PATH:
+        await anyio.to_thread.run_sync(spam_index.save, settings.SPAM_INDEX_PATH)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(assets.CompressionMiddleware, minimum_size=settings.GZIP_MIN_SIZE, excluded_paths=('/static/', '/media/'))
+app.add_middleware(metrics.MetricsMiddleware, slow_request_seconds=settings.SLOW_REQUEST_SECONDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
-app.mount("/static", StaticFiles(directory="static"), name="static")
-templates = Jinja2Templates(directory="templates")
+app.mount("/static", assets.PrecompressedStaticFiles(directory=assets.STATIC_DIR), name="static")
+app.mount("/media", MediaFiles(directory=settings.MEDIA_ROOT), name="media")
+templates = Jinja2Templates(
+    directory="templates",
+    bytecode_cache=jinja2.FileSystemBytecodeCache(settings.TEMPLATE_CACHE_DIR),
+    auto_reload=settings.TEMPLATE_AUTO_RELOAD,
+)
+templates.env.template_class = metrics.TimedTemplate
+
+
+@jinja2.pass_context
+def message_card(context, message, type=None, public=False):
+    name = 'components/sent_message_card.html' if type == 'sent' else 'components/received_message_card.html'
+    request = context['request']
+    # links in the card are absolute
+    key = (
+        name, message.id, message.is_public, message.is_featured, message.is_seen, bool(public),
+        getattr(message, 'sender_name', None), getattr(message, 'receiver_name', None), str(request.base_url),
+        message.sent_at, message.image, message.content,
+    )
+    card = cache.message_card_cache.get(key)
+    if card is None:
+        card = Markup(templates.get_template(name).render(request=request, message=message, public=public))
+        cache.message_card_cache.set(key, card)
+    return card
+
+
+templates.env.globals['message_card'] = message_card
+
+
+@jinja2.pass_context
+def media_url(context, name: str, size: int | None = None, square: bool = False):
+    if size:
+        name = resized_name(name, size, square)
+    return context['request'].url_for('media', path=media_path(name))
+
+
+templates.env.globals['media_url'] = media_url
+templates.env.globals['static_url'] = assets.static_url
+templates.env.globals['THUMBNAIL_SIZE'] = settings.MEDIA_THUMBNAIL_SIZE
+
+metrics.Stats('whisper_cache', 'Cache counters, see cache.TTLCache.', cache.token_cache.stats, cache='token')
+metrics.Stats('whisper_cache', 'Cache counters, see cache.TTLCache.', cache.user_cache.stats, cache='user')
+metrics.Stats('whisper_cache', 'Cache counters, see cache.TTLCache.', cache.public_page_cache.stats, cache='public_page')
+metrics.Stats('whisper_cache', 'Cache counters, see cache.TTLCache.', cache.message_card_cache.stats, cache='message_card')
+metrics.Stats('whisper_password_hasher', 'Password hashing pool counters.', password_hasher.stats)
+metrics.Stats('whisper_message_writer', 'Group commit counters.', message_writer.stats)
+metrics.Stats('whisper_message_rate_limit', 'Message rate limiter counters.', ratelimit.messages_per_ip.stats, key='ip')
+metrics.Stats('whisper_message_rate_limit', 'Message rate limiter counters.', ratelimit.messages_per_receiver.stats, key='receiver')
+metrics.Stats('whisper_message_rate_limit', 'Message rate limiter counters.', ratelimit.messages_per_sender.stats, key='sender')
+metrics.Stats('whisper_notifications', 'Notification digest counters.', digest_worker.stats)
+metrics.Stats('whisper_spam_index', 'Near-duplicate message detection counters.', spam_index.stats)
+metrics.Stats('whisper_write_requests', 'Write routes concurrency cap counters.', ratelimit.write_limit.stats)
 
 
 # Exception handlers
@@ -41,9 +137,73 @@ async def requires_login(request: Request, _: Exception):
     return RedirectResponse(f"/login?next={quote(request.url.path)}", status_code=status.HTTP_302_FOUND)
 
 
+# malformed pagination cursor
+@app.exception_handler(InvalidCursor)
+async def invalid_cursor(request: Request, _: Exception):
+    return PlainTextResponse('Invalid cursor', status_code=status.HTTP_400_BAD_REQUEST)
+
+
+# too many messages from a client, or to a user
+@app.exception_handler(RateLimited)
+async def rate_limited(request: Request, exc: RateLimited):
+    return PlainTextResponse(
+        'Too many messages, try again later',
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={'Retry-After': str(exc.retry_after)},
+    )
+
+
+# the resize pool lost a worker, it is restarted by the next upload
+@app.exception_handler(ImageWorkersFailed)
+async def image_workers_failed(request: Request, _: Exception):
+    return PlainTextResponse(
+        'The image could not be processed, try again shortly',
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={'Retry-After': '1'},
+    )
+
+
+# write routes at their concurrency cap, shed instead of queueing
+@app.exception_handler(WritesBusy)
+async def writes_busy(request: Request, _: Exception):
+    return PlainTextResponse(
+        'Server busy, try again shortly',
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={'Retry-After': '1'},
+    )
+
+
+# near-duplicate of messages just sent to the receiver, or to many users
+@app.exception_handler(SpamDetected)
+async def spam_detected(request: Request, _: Exception):
+    return PlainTextResponse('This message looks like spam', status_code=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+
+# rejected uploads
+@app.exception_handler(InvalidUpload)
+async def invalid_upload(request: Request, exc: InvalidUpload):
+    return PlainTextResponse(str(exc), status_code=status.HTTP_400_BAD_REQUEST)
+
+
+@app.exception_handler(UploadTooLarge)
+async def upload_too_large(request: Request, exc: UploadTooLarge):
+    return PlainTextResponse(str(exc), status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+
+# too many logins/registrations waiting for bcrypt, shed instead of queueing
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy(request: Request, _: Exception):
+    return PlainTextResponse(
+        'Server busy, try again shortly',
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={'Retry-After': '1'},
+    )
+
+
 # Dependency
+# Request sessions only read, writes go through run_write() (sharding.run_write() for messages)
 def get_db():
-    db = SessionLocal()
+    db = ReadSessionLocal()
     try:
         yield db
     finally:
@@ -59,24 +219,38 @@ async def _get_current_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get('email')
-        if email is None:
+    claims = cache.token_cache.get(token)
+    if claims is None:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            email: str = payload.get('email')
+            if email is None:
+                raise credentials_exception
+        except JWTError:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = crud.get_user_by_email(db, email=email)
-    if user is None:
-        raise credentials_exception
+        claims = {'email': email, 'exp': payload.get('exp'), 'user_id': None}
+    user = cache.user_cache.get(claims['user_id'])
+    # the email check rejects tokens issued before an email change, as a lookup by email would
+    if user is None or user.email != claims['email']:
+        db_user = await run_db(crud.get_user_by_email, db, email=claims['email'])
+        if db_user is None:
+            raise credentials_exception
+        user = schemas.UserSnapshot.model_validate(db_user, from_attributes=True)
+        cache.user_cache.set(user.id, user)
+    if claims['user_id'] is None:
+        claims['user_id'] = user.id
+        ttl = cache.token_cache.ttl
+        if claims['exp']:
+            ttl = min(ttl, claims['exp'] - datetime.now(timezone.utc).timestamp())
+        cache.token_cache.set(token, claims, ttl=ttl)
     return user
 
 
-def _authenticate_user(email: str, password: str, db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, email)
+async def _authenticate_user(email: str, password: str, db: Session = Depends(get_db)):
+    user = await run_db(crud.get_user_by_email, db, email)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await password_hasher.verify(password, user.hashed_password):
         return False
     return user
 
@@ -93,6 +267,11 @@ def _create_access_token(data: dict, expires_delta: timedelta | None = None):
 
 async def _get_request_user(request: Request, db: Session = Depends(get_db)):
     token = request.cookies.get('auth_token')
+    if not token:
+        # API clients send the token returned by POST /login as a bearer token
+        scheme, _, credentials = request.headers.get('authorization', '').partition(' ')
+        if scheme.lower() == 'bearer':
+            token = credentials
     if token:
         try:
             user = await _get_current_user(token, db)
@@ -101,13 +280,58 @@ async def _get_request_user(request: Request, db: Session = Depends(get_db)):
             return None
     return None
 
+
+def _next_page_url(request: Request, messages: list, url=None):
+    cursor = next_cursor(messages, PAGE_SIZE)
+    if not cursor:
+        return None
+    return str((url or request.url).include_query_params(cursor=cursor))
+
+
+# JSON mirror of the API endpoints, for clients sending Accept: application/json.
+# Rows are dumped with orjson as they come from crud, without going through
+# pydantic models.
+def _wants_json(request: Request) -> bool:
+    return 'application/json' in request.headers.get('accept', '')
+
+
+async def _write_slot():
+    with ratelimit.write_limit.slot():
+        yield
+
+
+def _user_json(user) -> dict:
+    return {'id': user.id, 'name': user.name, 'gender': user.gender, 'bio': user.bio, 'joined_at': user.joined_at, 'avatar': user.avatar}
+
+
+def _messages_json(messages: list, next_url: str | None) -> ORJSONResponse:
+    return ORJSONResponse({'messages': [message._asdict() for message in messages], 'next': next_url})
+
+
+def _unauthorized():
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Could not validate credentials",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+def _publish_new_message(request: Request, message: models.Message, sender_name: str | None):
+    # push the rendered card to the receiver's open inbox tabs, if any
+    if not broker.has_subscribers(message.receiver_id):
+        return
+    message = schemas.MessageRow.from_message(message, sender_name=sender_name)
+    fragment = templates.get_template('components/new_message_oob.html').render(
+        {'request': request, 'message': message, 'public': False}
+    )
+    broker.publish(message.receiver_id, fragment)
+
 # Template Responses
 # Auth views
 @app.get("/register", response_class=HTMLResponse)
 async def register(request: Request) -> schemas.Token:
     user = await _get_request_user(request)
     if user:
-        print('redirectiing to /messages/ ...')
         return RedirectResponse('/messages/', status_code=status.HTTP_302_FOUND)
     return templates.TemplateResponse(request=request, name="register.html")
 
@@ -120,8 +344,11 @@ async def register(
 ) -> schemas.Token:
     try:
         info = schemas.UserCreate(email=email, name=name, gender=gender, password=password)
-        user = crud.create_user(db, info)
+        hashed_password = await password_hasher.hash(info.password)
+        user = await run_write(crud.create_user, info, hashed_password)
         return RedirectResponse('/login/', status_code=status.HTTP_302_FOUND)
+    except PasswordHasherBusy:
+        raise
     except:
         return RedirectResponse('/register/', status_code=status.HTTP_302_FOUND)
         # return HTTPException(
@@ -133,11 +360,8 @@ async def register(
 
 @app.get("/login", response_class=HTMLResponse)
 async def login(request: Request) -> schemas.Token:
-    print('get login')
     user = await _get_request_user(request)
-    print('user =', user)
     if user:
-        print('redirectiing to /messages/ ...')
         return RedirectResponse('/messages/', status_code=status.HTTP_302_FOUND)
     return templates.TemplateResponse(request=request, name="login.html")
 
@@ -148,10 +372,7 @@ async def login(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     db: Session = Depends(get_db)
 ) -> schemas.Token:
-    print('form data =', form_data.username,  form_data.password)
-    print(f'query_params = {request.query_params}')
-    print(f'path_params = {request.path_params}')
-    user = _authenticate_user(form_data.username, form_data.password, db)
+    user = await _authenticate_user(form_data.username, form_data.password, db)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -162,6 +383,8 @@ async def login(
     access_token = _create_access_token(
         data={'email': user.email}, expires_delta=access_token_expires
     )
+    if _wants_json(request):
+        return ORJSONResponse({'access_token': access_token, 'token_type': 'bearer'})
     target = request.query_params.get('next', default='/messages/')
     response = RedirectResponse(target, status_code=status.HTTP_302_FOUND)
     response.set_cookie(key='auth_token', value=access_token, httponly=True)
@@ -187,7 +410,7 @@ async def profile_page(request: Request, db: Session = Depends(get_db)):
     )
 
 
-@app.post(f'{API_VERSION}/info/', response_class=HTMLResponse)
+@app.post(f'{API_VERSION}/info/', response_class=HTMLResponse, dependencies=[Depends(_write_slot)])
 async def update_user_info(
     request: Request,
     name: str = Form(...), email: str = Form(...), gender: str = Form(...), bio: str = Form(...),
@@ -198,13 +421,29 @@ async def update_user_info(
         raise RequiresLogin("You must be logged in to access this")
     try:
         info = schemas.UserInfo(name=name, email=email, gender=gender, bio=bio)
-        user = crud.update_user_info(db, user.id, info)
+        user = await run_write(crud.update_user_info, user.id, info)
         return RedirectResponse('/profile/', status_code=status.HTTP_302_FOUND)
     except:
         return templates.TemplateResponse(request, name='components/alert.html', context={'type': 'danger', 'message': 'Error try again later'})
 
 
-@app.post(f'{API_VERSION}/privacy', response_class=HTMLResponse)
+@app.post(f'{API_VERSION}/avatar/', response_class=HTMLResponse, dependencies=[Depends(_write_slot)])
+async def update_user_avatar(request: Request, db: Session = Depends(get_db)):
+    user = await _get_request_user(request, db)
+    if not user:
+        raise RequiresLogin("You must be logged in to access this")
+    await run_db(db.rollback)
+    _, upload = await media_store.receive_form(request, 'avatar')
+    if upload is None:
+        raise InvalidUpload('No picture was uploaded')
+    _, avatar = await media_store.save_image(upload, settings.MEDIA_AVATAR_SIZE, square=True)
+    await run_write(crud.update_user_avatar, user.id, avatar)
+    if _wants_json(request):
+        return ORJSONResponse({'avatar': avatar})
+    return RedirectResponse('/profile/', status_code=status.HTTP_302_FOUND)
+
+
+@app.post(f'{API_VERSION}/privacy', response_class=HTMLResponse, dependencies=[Depends(_write_slot)])
 async def update_user_privacy_settings(
     request: Request,
     allow_new_messages: Optional[bool] = Form(False),
@@ -229,8 +468,7 @@ async def update_user_privacy_settings(
             hide_last_seen=hide_last_seen,
             appear_in_search_results=appear_in_search_results,
         )
-        print('settings =', settings.dict())
-        user = crud.update_user_privacy_settings(db, user.id, settings)
+        user = await run_write(crud.update_user_privacy_settings, user.id, settings)
         return RedirectResponse('/profile/', status_code=status.HTTP_302_FOUND)
         # templates.TemplateResponse(request, name='profile.html', context={'user': user})
     except:
@@ -242,7 +480,7 @@ async def messages_page(request: Request, db: Session = Depends(get_db)):
     request_user = await _get_request_user(request, db)
     if not request_user:
         raise RequiresLogin("You must be logged in to access this")
-    context = {'user': request_user, 'messages': request_user.received_messages}
+    context = {'user': request_user}
     return templates.TemplateResponse(
         request=request, name="messages.html", context=context
     )
@@ -254,64 +492,136 @@ def search_page(request: Request):
 
 
 @app.get(f'{API_VERSION}/users/', response_class=HTMLResponse)
-def search_users(request: Request, db: Session = Depends(get_db)):
-    q = request.query_params.get('q')
-    users = crud.search_users(q, db)
-    print('users =', users)
-    if users:
+def search_users(request: Request, skip: int = 0, db: Session = Depends(get_db)):
+    q = (request.query_params.get('q') or '').strip()
+    users = crud.search_users(q, db, skip=skip, limit=settings.USERS_PAGE_SIZE) if q else []
+    if users or skip:
+        next_url = None
+        if len(users) == settings.USERS_PAGE_SIZE:
+            next_url = str(request.url.include_query_params(skip=skip + len(users)))
+        if _wants_json(request):
+            return ORJSONResponse({'users': [_user_json(u) for u in users], 'next': next_url})
         users = [schemas.UserSearchResult(email=u.email, name=u.name, gender=u.gender, bio=u.bio or '', id=u.id, joined_at=u.joined_at) for u in users]
-        return templates.TemplateResponse(request, name='components/users_list.html', context={'users': users})
+        return templates.TemplateResponse(request, name='components/users_list.html', context={'users': users, 'next_url': next_url})
+    if _wants_json(request):
+        return ORJSONResponse({'users': [], 'next': None})
     return templates.TemplateResponse(request, name='components/user_not_found.html')
 
 
 @app.get('/users/{user_id}', response_class=HTMLResponse)
 async def read_user(request: Request, user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
-    if db_user is None:
-        raise HTTPException(status_code=404, detail='User not found')
     request_user = await _get_request_user(request, db)
-    if request_user and request_user.id == db_user.id:
+    if request_user and request_user.id == user_id:
         return RedirectResponse('/messages/', status_code=status.HTTP_302_FOUND)
-    messages = crud.get_public_messages(db, user_id)
-    user = crud.increase_user_visitors(db, user_id)
-    context = {'user': user, 'messages': messages}
+    as_json = _wants_json(request)
+    # the page links are absolute, built from the request's host
+    key = (user_id, cache.wall_version(user_id), as_json, str(request.base_url))
+    page = cache.public_page_cache.get(key)
+    if page is None:
+        db_user = await run_db(crud.get_user, db, user_id=user_id)
+        if db_user is None:
+            raise HTTPException(status_code=404, detail='User not found')
+        messages = await run_db(crud.get_public_messages, db, user_id, limit=PAGE_SIZE)
+        num_of_visitors = (db_user.num_of_visitors or 0) + visitor_counter.pending(user_id) + 1
+        next_url = _next_page_url(request, messages, request.url_for('read_public_messages', user_id=user_id))
+        if as_json:
+            body = orjson.dumps({
+                'user': _user_json(db_user),
+                'num_of_visitors': None if db_user.hide_visitors_count else num_of_visitors,
+                'messages': [message._asdict() for message in messages],
+                'next': next_url,
+            })
+        else:
+            context = {'request': request, 'user': db_user, 'num_of_visitors': num_of_visitors, 'messages': messages, 'next_url': next_url}
+            body = templates.get_template('user_page.html').render(context).encode()
+        page = (body, '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"')
+        cache.public_page_cache.set(key, page)
+    visitor_counter.increment(user_id)
+    body, etag = page
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept'}
+    if etag_matches(request.headers.get('if-none-match', ''), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(body, media_type='application/json' if as_json else 'text/html', headers=headers)
+
+
+@app.get(API_VERSION+'/users/{user_id}/messages/', response_class=HTMLResponse)
+async def read_public_messages(request: Request, user_id: int, cursor: str | None = None, db: Session = Depends(get_db)):
+    messages = await run_db(crud.get_public_messages, db, user_id, cursor=cursor, limit=PAGE_SIZE)
+    if _wants_json(request):
+        return _messages_json(messages, _next_page_url(request, messages))
     return templates.TemplateResponse(
-        request=request, name="user_page.html", context=context
+        request=request,
+        name='components/messages_list.html',
+        context={'messages': messages, 'public': True, 'next_url': _next_page_url(request, messages)}
     )
 
 
-@app.post('/users/{user_id}/messages/', response_class=HTMLResponse)
+@app.post('/users/{user_id}/messages/', response_class=HTMLResponse, dependencies=[Depends(_write_slot)])
 async def create_messsage_for_user(
     request: Request,
     user_id: int,
-    content: str = Form(...),
-    anonymously: Optional[bool] = Form(False),
     db: Session = Depends(get_db)
 ):
-    user = crud.get_user(db, user_id=user_id)
+    user = await run_db(crud.get_user, db, user_id=user_id)
     if user is None:
         raise HTTPException(status_code=404, detail='User not found')
     request_user = await _get_request_user(request, db)
+    # checked before the body is read, a rejected post costs no upload
+    client_ip = request.client.host if request.client else None
+    ratelimit.limit_message(client_ip, user.id, request_user.id if request_user else None)
+    # the read transaction is not kept open while the body is received, nor
+    # while a group commit is queued
+    await run_db(db.rollback)
+    # read here rather than with Form() parameters: an attached image is
+    # streamed to the media store instead of being spooled by the form parser
+    form, upload = await media_store.receive_form(request, 'image', accept_file=user.allow_sending_images)
+    image = None
+    try:
+        if 'content' not in form:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='content is required')
+        spam_index.check(form['content'], user.id, request_user.id if request_user else client_ip)
+        if upload is not None:
+            image, _ = await media_store.save_image(upload, settings.MEDIA_THUMBNAIL_SIZE)
+    finally:
+        # the temporary file of an upload that was not saved
+        if upload is not None:
+            await upload.discard()
     kwargs = {
-        'content': content,
-        'is_anonymous': anonymously,
+        'content': form['content'],
+        'is_anonymous': form.get('anonymously', 'false').lower() in ('1', 'true', 'on', 'yes'),
         'receiver_id': user.id,
-        'sender_id': request_user.id if request_user else None
+        'sender_id': request_user.id if request_user else None,
+        'image': image,
     }
     new_message = schemas.MessageCreate(**kwargs)
     # save the message
-    message = crud.create_message(db=db, message=new_message)
+    if settings.MESSAGE_GROUP_COMMIT:
+        message = await message_writer.submit(new_message)
+    else:
+        message = await sharding.run_write(user.id, crud.create_message, message=new_message)
     if message:
+        _publish_new_message(request, message, request_user.name if request_user else None)
+        if _wants_json(request):
+            message = schemas.MessageRow.from_message(message, sender_name=request_user.name if request_user else None)
+            return ORJSONResponse(message._asdict(), status_code=status.HTTP_201_CREATED)
         return RedirectResponse('/success/', status_code=status.HTTP_302_FOUND)
     return '<div> error </div>'
 
 
+@app.get('/metrics', include_in_schema=False)
+def read_metrics(request: Request):
+    token = request.headers.get('authorization', '').removeprefix('Bearer ')
+    if not settings.METRICS_TOKEN or not hmac.compare_digest(token.encode(), settings.METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
 @app.get('/success/', response_class=HTMLResponse)
 async def message_sent_successfuly(request: Request):
     return templates.TemplateResponse(request, 'message_sent_successfuly.html')
 
 
-@app.patch(API_VERSION+'/messages/{message_id}', response_class=HTMLResponse)
+@app.patch(API_VERSION+'/messages/{message_id}', response_class=HTMLResponse, dependencies=[Depends(_write_slot)])
 async def edit_message(
     request: Request,
     message_id: int,
@@ -320,30 +630,34 @@ async def edit_message(
     data = await request.json()
     is_public = data.get('is_public')
     is_featured = data.get('is_featured')
-    message = crud.get_message_by_id(db, message_id)
+    request_user = await _get_request_user(request, db)
+    if not request_user:
+        raise _unauthorized()
+    # looked up in the user's own shard, other users' messages are not found
+    message = await run_db(crud.get_message_by_id, db, message_id, request_user.id)
     if not message:
-        return HTTPException(
+        raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Message Not Found"
         )
-    request_user = await _get_request_user(request, db)
-    if not request_user or message.receiver_id != request_user.id:
-        return HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Unauthorized action",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
+    flags = {key: bool(value) for key, value in data.items() if key in ('is_public', 'is_featured') and value is not None}
+    if _wants_json(request):
+        # both flags can be set at once
+        if flags:
+            await sharding.run_write(request_user.id, crud.update_message_flags, message_id, request_user.id, flags)
+            if 'is_public' in flags:
+                cache.invalidate_wall(request_user.id)
+        return ORJSONResponse({'id': message_id, **flags})
     if is_public is not None:
-        message.is_public = is_public
-        db.commit()
+        await sharding.run_write(request_user.id, crud.update_message_flags, message_id, request_user.id, {'is_public': is_public})
+        cache.invalidate_wall(request_user.id)
         return templates.TemplateResponse(
             request=request,
             name=f'components/{"hide" if is_public else "show"}_message_btn.html',
             context={'message_id': message_id}
         )
     elif is_featured is not None:
-        message.is_featured = is_featured
-        db.commit()
+        await sharding.run_write(request_user.id, crud.update_message_flags, message_id, request_user.id, {'is_featured': is_featured})
         return templates.TemplateResponse(
             request=request,
             name=f'components/{"unfav" if is_featured else "fav"}_btn.html',
@@ -352,25 +666,44 @@ async def edit_message(
     return ''
 
 
+@app.post(API_VERSION+'/messages/moderate', response_class=HTMLResponse, dependencies=[Depends(_write_slot)])
+async def moderate_messages(request: Request, moderation: schemas.MessagesModeration, db: Session = Depends(get_db)):
+    request_user = await _get_request_user(request, db)
+    if not request_user:
+        raise _unauthorized()
+    ids = await sharding.run_write(request_user.id, crud.moderate_messages, request_user.id, moderation.ids, moderation.action)
+    if moderation.action in ('publish', 'hide', 'delete') and ids:
+        cache.invalidate_wall(request_user.id)
+    if _wants_json(request):
+        return ORJSONResponse({'action': moderation.action, 'ids': ids})
+    messages = [] if moderation.action == 'delete' else await run_db(crud.get_messages_by_ids, db, request_user.id, ids)
+    # out of band swaps of the cards in the inbox, by their message-<id> containers
+    return templates.TemplateResponse(
+        request=request,
+        name='components/moderated_messages_oob.html',
+        context={'messages': messages, 'deleted_ids': ids if moderation.action == 'delete' else []},
+    )
+
+
 @app.get(f'{API_VERSION}/messages/', response_class=HTMLResponse)
-async def read_received_messages(request: Request, db: Session = Depends(get_db)):
+async def read_received_messages(request: Request, cursor: str | None = None, db: Session = Depends(get_db)):
     request_user = await _get_request_user(request, db)
     if not request_user:
-        return HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    crud.set_user_messages_seen(db, request_user.id)
-    messages = crud.get_messages(db, filters={'receiver_id': request_user.id})
-    if messages:
-        messages = [
-            schemas.AnonymousMessage(**m.__dict__) if m.is_anonymous else schemas.Message(**m.__dict__) for m in messages
-        ]
+        raise _unauthorized()
+    if cursor is None:
+        # checked on a reader first, the writer is only queued for when there is something to mark
+        summary = await run_db(crud.get_inbox_summary, db, request_user.id)
+        if summary and summary.unread_count:
+            await sharding.run_write(request_user.id, crud.set_user_messages_seen, request_user.id)
+    messages = await run_db(crud.get_messages, db, filters={'receiver_id': request_user.id}, cursor=cursor, limit=PAGE_SIZE)
+    if _wants_json(request):
+        return _messages_json(messages, _next_page_url(request, messages))
+    if messages or cursor:
+        next_url = _next_page_url(request, messages)
         return templates.TemplateResponse(
             request=request,
             name='components/messages_list.html',
-            context={'messages': messages, 'public': False}
+            context={'messages': messages, 'public': False, 'next_url': next_url, 'list_id': None if cursor else 'received-messages'}
         )
     return templates.TemplateResponse(
         request=request,
@@ -378,22 +711,66 @@ async def read_received_messages(request: Request, db: Session = Depends(get_db)
     )
 
 
-@app.get(f'{API_VERSION}/messages/sent', response_class=HTMLResponse)
-async def read_sent_messages(request: Request, db: Session = Depends(get_db)):
+@app.get(f'{API_VERSION}/messages/summary', response_class=HTMLResponse)
+async def read_inbox_summary(request: Request, db: Session = Depends(get_db)):
     request_user = await _get_request_user(request, db)
     if not request_user:
-        return HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
+        if _wants_json(request):
+            raise _unauthorized()
+        return ''
+    summary = await run_db(crud.get_inbox_summary, db, request_user.id)
+    if _wants_json(request):
+        return ORJSONResponse({
+            'unread_count': summary.unread_count if summary else 0,
+            'total_count': summary.total_count if summary else 0,
+            'last_message_at': summary.last_message_at if summary else None,
+        })
+    return templates.TemplateResponse(
+        request=request,
+        name='components/inbox_summary.html',
+        context={'summary': summary}
+    )
+
+
+@app.get(f'{API_VERSION}/messages/search', response_class=HTMLResponse)
+async def search_received_messages(request: Request, q: str = '', cursor: str | None = None, db: Session = Depends(get_db)):
+    request_user = await _get_request_user(request, db)
+    if not request_user:
+        raise _unauthorized()
+    q = q.strip()
+    if q:
+        messages = await run_db(crud.search_messages, db, request_user.id, q, cursor=cursor, limit=PAGE_SIZE)
+    else:
+        messages = await run_db(crud.get_messages, db, filters={'receiver_id': request_user.id}, cursor=cursor, limit=PAGE_SIZE)
+    if _wants_json(request):
+        return _messages_json(messages, _next_page_url(request, messages))
+    if messages or cursor:
+        next_url = _next_page_url(request, messages)
+        return templates.TemplateResponse(
+            request=request,
+            name='components/messages_list.html',
+            context={'messages': messages, 'public': False, 'next_url': next_url}
         )
-    messages = crud.get_messages(db, filters={'sender_id': request_user.id})
-    if messages:
-        messages = [schemas.SentMessage(**m.__dict__, receiver=m.receiver.__dict__) for m in messages]
+    return templates.TemplateResponse(
+        request=request,
+        name='components/no_messages_found.html'
+    )
+
+
+@app.get(f'{API_VERSION}/messages/sent', response_class=HTMLResponse)
+async def read_sent_messages(request: Request, cursor: str | None = None, db: Session = Depends(get_db)):
+    request_user = await _get_request_user(request, db)
+    if not request_user:
+        raise _unauthorized()
+    messages = await run_db(crud.get_sent_messages, db, request_user.id, cursor=cursor, limit=PAGE_SIZE)
+    if _wants_json(request):
+        return _messages_json(messages, _next_page_url(request, messages))
+    if messages or cursor:
+        next_url = _next_page_url(request, messages)
         return templates.TemplateResponse(
             request=request,
             name='components/messages_list.html',
-            context={'type': 'sent', 'messages': messages, 'public': False}
+            context={'type': 'sent', 'messages': messages, 'public': False, 'next_url': next_url}
         )
     return templates.TemplateResponse(
         request=request,
@@ -402,25 +779,77 @@ async def read_sent_messages(request: Request, db: Session = Depends(get_db)):
 
 
 @app.get(f'{API_VERSION}/messages/fav', response_class=HTMLResponse)
-async def read_fav_messages(request: Request, db: Session = Depends(get_db)):
+async def read_fav_messages(request: Request, cursor: str | None = None, db: Session = Depends(get_db)):
     request_user = await _get_request_user(request, db)
     if not request_user:
-        return HTTPException(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            detail="Could not validate credentials",
-            headers={"WWW-Authenticate": "Bearer"},
-        )
-    messages = crud.get_fav_messages(db, user_id=request_user.id)
-    if messages:
-        messages = [
-            schemas.AnonymousMessage(**m.__dict__) if m.is_anonymous else schemas.Message(**m.__dict__) for m in messages
-        ]
+        raise _unauthorized()
+    messages = await run_db(crud.get_fav_messages, db, user_id=request_user.id, cursor=cursor, limit=PAGE_SIZE)
+    if _wants_json(request):
+        return _messages_json(messages, _next_page_url(request, messages))
+    if messages or cursor:
+        next_url = _next_page_url(request, messages)
         return templates.TemplateResponse(
             request=request,
             name='components/messages_list.html',
-            context={'user_type': 'R', 'messages': messages, 'public': False}
+            context={'user_type': 'R', 'messages': messages, 'public': False, 'next_url': next_url}
         )
     return templates.TemplateResponse(
         request=request,
         name='components/no_fav_messages.html'
     )
+
+
+@app.get(f'{API_VERSION}/messages/export')
+async def export_received_messages(request: Request, db: Session = Depends(get_db)):
+    request_user = await _get_request_user(request, db)
+    if not request_user:
+        raise _unauthorized()
+    user_id = request_user.id
+
+    # one JSON object per line, streamed chunk by chunk on its own session
+    # (the request session is closed once the response starts)
+    async def lines():
+        with ReadSessionLocal() as export_db:
+            chunks = crud.iter_received_messages(export_db, user_id, settings.EXPORT_CHUNK_SIZE)
+            try:
+                while chunk := await run_db(next, chunks, None):
+                    yield b''.join(orjson.dumps(message._asdict()) + b'\n' for message in chunk)
+            finally:
+                await run_db(chunks.close)
+
+    return StreamingResponse(
+        lines(),
+        media_type='application/x-ndjson',
+        headers={'Content-Disposition': 'attachment; filename="messages.ndjson"'},
+    )
+
+
+@app.websocket('/ws/messages')
+async def messages_feed(websocket: WebSocket):
+    # the session cookie goes with cross-site handshakes too, browsers always send their Origin
+    origin = websocket.headers.get('origin')
+    if origin and urlsplit(origin).netloc.lower() != websocket.headers.get('host', '').lower():
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    with ReadSessionLocal() as db:
+        request_user = await _get_request_user(websocket, db)
+    if not request_user:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    queue = broker.subscribe(request_user.id)
+
+    async def forward():
+        while True:
+            await websocket.send_text(await queue.get())
+
+    sender = asyncio.create_task(forward())
+    try:
+        # the client never sends anything, this only waits for the disconnect
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        sender.cancel()
+        broker.unsubscribe(request_user.id, queue)
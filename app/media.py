@@ -0,0 +1,357 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import re
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import anyio
+from multipart.multipart import MultipartParser, parse_options_header
+from starlette.datastructures import Headers
+from starlette.requests import Request
+from starlette.responses import Response, StreamingResponse
+from starlette.staticfiles import StaticFiles
+from .config import get_settings
+from .exceptions import ImageWorkersFailed, InvalidUpload, UploadTooLarge
+
+
+# Content-addressed media store. Uploads are streamed to a temporary file in
+# chunks while they are hashed (outside the served root, on the same file
+# system), then renamed to `<sha256>.<ext>` under two
+# levels of directories: the same image uploaded twice is stored once, and a
+# stored file never changes, so it is served with immutable cache headers.
+# Resized copies (`<sha256>_<size>.jpg`) are made by Pillow in a process
+# pool, never in the event loop or the request threads.
+
+# accepted formats, recognized by their first bytes rather than the client's content type
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+]
+MAX_IMAGE_PIXELS = 40_000_000  # larger images are rejected by the workers
+MAX_FIELD_SIZE = 64 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+def _image_type(head: bytes) -> str | None:
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    return None
+
+
+def media_path(name: str) -> str:
+    # relative to the store root and the /media mount
+    return f'{name[:2]}/{name[2:4]}/{name}'
+
+
+def resized_name(name: str, size: int, square: bool = False) -> str:
+    return f"{name.split('.')[0].split('_')[0]}_{size}{'s' if square else ''}.jpg"
+
+
+def _resize(source: str, target: str, size: int, square: bool):
+    # runs in a worker process, Pillow is only imported there
+    if os.path.exists(target):
+        return
+    from PIL import Image, ImageOps
+    Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        if square:
+            image = ImageOps.fit(image, (size, size))
+        else:
+            image.thumbnail((size, size))
+        tmp = f'{target}.{uuid.uuid4().hex}.tmp'
+        image.convert('RGB').save(tmp, 'JPEG', quality=85, optimize=True)
+    os.replace(tmp, target)
+
+
+class Upload:
+    """A file part written to the store's temporary directory as it is received."""
+
+    def __init__(self, store: 'MediaStore', field_name: str, filename: str):
+        self.store = store
+        self.field_name = field_name
+        self.filename = filename
+        self.size = 0
+        # set once this upload put its file in the store, not if it was there already
+        self.stored = False
+        self._head = b''
+        self._hash = hashlib.sha256()
+        self._path = os.path.join(store.tmp_dir, uuid.uuid4().hex)
+        self._file = None
+
+    def _write(self, data: bytes):
+        if self._file is None:
+            self._file = open(self._path, 'wb')
+        self._file.write(data)
+
+    async def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.store.max_size:
+            raise UploadTooLarge(f'Files are limited to {self.store.max_size // (1024 * 1024)} MiB')
+        if len(self._head) < 16:
+            self._head += data[:16]
+        self._hash.update(data)
+        await anyio.to_thread.run_sync(self._write, data)
+
+    def _save(self, name: str):
+        self._file.close()
+        path = os.path.join(self.store.root, media_path(name))
+        if os.path.exists(path):
+            # already stored
+            os.remove(self._path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self._path, path)
+        self.stored = True
+
+    async def save(self) -> str:
+        """Move the upload to its content address, returns its name."""
+        ext = _image_type(self._head)
+        if ext is None:
+            await self.discard()
+            raise InvalidUpload('Only JPEG, PNG, GIF and WebP images are supported')
+        name = f'{self._hash.hexdigest()}.{ext}'
+        await anyio.to_thread.run_sync(self._save, name)
+        return name
+
+    def _discard(self):
+        if self._file is not None:
+            self._file.close()
+            if os.path.exists(self._path):
+                os.remove(self._path)
+
+    async def discard(self):
+        # also when the request is cancelled
+        with anyio.CancelScope(shield=True):
+            await anyio.to_thread.run_sync(self._discard)
+
+
+class _FormReader:
+    # python-multipart callbacks, as in starlette's MultiPartParser, except
+    # that file data goes to an Upload instead of a spooled temporary file
+    def __init__(self, store: 'MediaStore', file_field: str, accept_file: bool):
+        self.store = store
+        self.file_field = file_field
+        self.accept_file = accept_file
+        self.fields = {}
+        self.upload = None
+        self._charset = 'utf-8'
+        self._header_field = b''
+        self._header_value = b''
+        self._disposition = b''
+        self._field_name = None
+        self._data = b''
+        self._is_file = False
+        self._chunks = []
+
+    def on_part_begin(self):
+        self._disposition = b''
+        self._data = b''
+        self._is_file = False
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._is_file:
+            self._chunks.append(data[start:end])
+            return
+        self._data += data[start:end]
+        if len(self._data) > MAX_FIELD_SIZE:
+            raise InvalidUpload(f'Field {self._field_name} is too long')
+
+    def on_part_end(self):
+        if not self._is_file:
+            self.fields[self._field_name] = self._data.decode(self._charset, errors='replace')
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_field.lower() == b'content-disposition':
+            self._disposition = self._header_value
+        self._header_field = b''
+        self._header_value = b''
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b'name' not in options:
+            raise InvalidUpload('A form field has no name')
+        self._field_name = options[b'name'].decode(self._charset, errors='replace')
+        filename = options.get(b'filename')
+        # browsers send an empty part for a file input left empty
+        self._is_file = bool(filename)
+        if not self._is_file:
+            return
+        if self._field_name != self.file_field or self.upload is not None:
+            raise InvalidUpload(f'Unexpected file in field {self._field_name}')
+        if not self.accept_file:
+            raise InvalidUpload('Files are not accepted here')
+        self.upload = Upload(self.store, self._field_name, filename.decode(self._charset, errors='replace'))
+
+    async def read(self, request: Request):
+        _, params = parse_options_header(request.headers['content-type'])
+        if b'boundary' not in params:
+            raise InvalidUpload('Missing boundary in multipart form')
+        if b'charset' in params:
+            self._charset = params[b'charset'].decode('latin-1')
+        parser = MultipartParser(params[b'boundary'], {
+            'on_part_begin': self.on_part_begin,
+            'on_part_data': self.on_part_data,
+            'on_part_end': self.on_part_end,
+            'on_header_field': self.on_header_field,
+            'on_header_value': self.on_header_value,
+            'on_header_end': self.on_header_end,
+            'on_headers_finished': self.on_headers_finished,
+        })
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                if self._chunks:
+                    # one write per received chunk, off the event loop
+                    data, self._chunks = b''.join(self._chunks), []
+                    await self.upload.write(data)
+            parser.finalize()
+        except BaseException:
+            if self.upload is not None:
+                await self.upload.discard()
+            raise
+
+
+class MediaStore:
+    def __init__(self, root: str, tmp_dir: str, max_size: int, workers: int):
+        self.root = root
+        self.tmp_dir = tmp_dir
+        self.max_size = max_size
+        self.workers = workers
+        self._executor = None
+        os.makedirs(root, exist_ok=True)
+        os.makedirs(tmp_dir, exist_ok=True)
+
+    async def receive_form(self, request: Request, file_field: str, accept_file: bool = True) -> tuple[dict, Upload | None]:
+        """Read a form whose file in `file_field`, if any, is streamed to the store.
+
+        The upload still has to be saved (or discarded) by the caller.
+        """
+        content_type = request.headers.get('content-type', '')
+        if not content_type.startswith('multipart/form-data'):
+            form = await request.form()
+            return dict(form), None
+        length = request.headers.get('content-length')
+        if length and length.isdigit() and int(length) > self.max_size + MAX_FIELD_SIZE:
+            raise UploadTooLarge(f'Files are limited to {self.max_size // (1024 * 1024)} MiB')
+        reader = _FormReader(self, file_field, accept_file)
+        await reader.read(request)
+        return reader.fields, reader.upload
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawned, forked workers would inherit the server's threads and connections
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def resize(self, name: str, size: int, square: bool = False) -> str:
+        """Make a JPEG copy of a stored image fitting in size x size (cropped if square), returns its name."""
+        target = resized_name(name, size, square)
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        try:
+            await loop.run_in_executor(
+                executor, _resize,
+                os.path.join(self.root, media_path(name)), os.path.join(self.root, media_path(target)), size, square,
+            )
+        except BrokenProcessPool as e:
+            # a worker died (killed, out of memory), the next resize starts a new pool
+            if self._executor is executor:
+                self._executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise ImageWorkersFailed() from e
+        except Exception as e:
+            raise InvalidUpload('The image could not be read') from e
+        return target
+
+    async def save_image(self, upload: Upload, size: int, square: bool = False) -> tuple[str, str]:
+        """Save an upload and make its resized copy, returns both names.
+
+        An image that could not be resized is removed from the store again.
+        """
+        name = await upload.save()
+        try:
+            return name, await self.resize(name, size, square)
+        except (InvalidUpload, ImageWorkersFailed):
+            if upload.stored:
+                await anyio.to_thread.run_sync(os.remove, os.path.join(self.root, media_path(name)))
+            raise
+
+    async def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+_range_pattern = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+class MediaFiles(StaticFiles):
+    # stored files never change: cached for good by browsers and proxies,
+    # and byte ranges are served so large images can be resumed
+    def file_response(self, full_path, stat_result, scope, status_code=200) -> Response:
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        response.headers['cache-control'] = 'public, max-age=31536000, immutable'
+        request_headers = Headers(scope=scope)
+        range_header = request_headers.get('range')
+        if response.status_code != 200 or scope['method'] != 'GET' or not range_header:
+            response.headers['accept-ranges'] = 'bytes'
+            return response
+        if_range = request_headers.get('if-range')
+        if if_range and if_range != response.headers.get('etag'):
+            return response
+        return self._range_response(full_path, stat_result.st_size, range_header, response)
+
+    def _range_response(self, full_path, size: int, range_header: str, response: Response) -> Response:
+        headers = {
+            key: value for key, value in response.headers.items()
+            if key in ('cache-control', 'etag', 'last-modified', 'content-type')
+        }
+        match = _range_pattern.match(range_header.strip())
+        if match is None:
+            # several ranges, or not in bytes: the whole file is a valid answer
+            return response
+        start, end = match.groups()
+        if start:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+        elif end:
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            return response
+        if start > end or start >= size:
+            return Response(status_code=416, headers={**headers, 'content-range': f'bytes */{size}'})
+
+        async def content():
+            remaining = end - start + 1
+            async with await anyio.open_file(full_path, 'rb') as f:
+                await f.seek(start)
+                while remaining > 0:
+                    chunk = await f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
+        return StreamingResponse(content(), status_code=206, headers={
+            **headers,
+            'accept-ranges': 'bytes',
+            'content-range': f'bytes {start}-{end}/{size}',
+            'content-length': str(end - start + 1),
+        })
+
+
+_settings = get_settings()
+media_store = MediaStore(_settings.MEDIA_ROOT, _settings.MEDIA_TMP_DIR, _settings.MEDIA_MAX_UPLOAD_SIZE, _settings.MEDIA_WORKERS)
@@ -0,0 +1,222 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+import jinja2
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+# In-process metrics in the Prometheus text format, served at /metrics.
+# Histograms are fixed-bucket counters, cheap enough to observe on every
+# request and every query. Queries are attributed to the request that issued
+# them through a context variable, which also reaches the DB worker threads
+# (anyio copies the context into them).
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+
+def _labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(values, list(counts), total, count) for values, (counts, total, count) in self._series.items()]
+        for values, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = 'le="{}"'.format(bound)
+                lines.append(f'{self.name}_bucket{_labels(self.labels, values, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, values)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, values)} {count}')
+        return lines
+
+
+class Stats:
+    # exposes the numbers a component already keeps (its stats() dict) as
+    # `<prefix>_<key>` samples, collected when /metrics is scraped
+    def __init__(self, prefix: str, help: str, stats, **labels):
+        self.prefix = prefix
+        self.help = help
+        self.stats = stats
+        self.labels = labels
+        _registry.append(self)
+
+
+_registry = []
+
+
+def render() -> str:
+    lines = []
+    stats = {}
+    for metric in _registry:
+        if isinstance(metric, Histogram):
+            lines.extend(metric.collect())
+            continue
+        for key, value in metric.stats().items():
+            name = f'{metric.prefix}_{key}'
+            stats.setdefault(name, (metric.help, []))[1].append((tuple(metric.labels.items()), value))
+    # samples of one metric must be grouped, whichever component they come from
+    for name, (help, samples) in stats.items():
+        lines.append(f'# HELP {name} {help}')
+        lines.append(f'# TYPE {name} untyped')
+        for labels, value in samples:
+            lines.append(f'{name}{_labels(tuple(k for k, _ in labels), tuple(v for _, v in labels))} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+request_duration = Histogram(
+    'whisper_request_duration_seconds', 'Time to handle a request, until its body is sent.', ('method', 'route', 'status'),
+)
+request_db_queries = Histogram(
+    'whisper_request_db_queries', 'SQL statements executed per request.', ('route',), COUNT_BUCKETS,
+)
+request_db_seconds = Histogram(
+    'whisper_request_db_seconds', 'Time spent executing SQL statements per request.', ('route',),
+)
+db_query_duration = Histogram(
+    'whisper_db_query_duration_seconds', 'Execution time of SQL statements, by statement kind.', ('kind',),
+)
+db_write_wait = Histogram(
+    'whisper_db_write_wait_seconds', "Time waiting for a database's single writer connection.",
+)
+template_render_duration = Histogram(
+    'whisper_template_render_seconds', 'Time to render a page or fragment, by template.', ('template',),
+)
+password_hash_duration = Histogram(
+    'whisper_password_hash_seconds', 'Time bcrypt spends per hash or verification.', ('operation',),
+)
+password_hash_wait = Histogram(
+    'whisper_password_hash_wait_seconds', 'Time waiting for a free password hashing thread.',
+)
+
+
+class RequestStats:
+    __slots__ = ('queries', 'db_seconds', 'template_seconds', 'statements')
+
+    def __init__(self, record_statements: bool):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.statements = [] if record_statements else None
+
+
+_request_stats = contextvars.ContextVar('request_stats', default=None)
+
+
+# every engine, including the reader pools and the message shards
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started_at'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop('query_started_at', time.perf_counter())
+    db_query_duration.observe(elapsed, statement.lstrip().split(None, 1)[0].upper() if statement.strip() else '')
+    stats = _request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        if stats.statements is not None:
+            stats.statements.append((elapsed, statement))
+
+
+_rendering = contextvars.ContextVar('rendering', default=False)
+
+
+class TimedTemplate(jinja2.Template):
+    # only top level renders, included templates and fragments rendered while
+    # rendering a page are part of their parent's time
+    def render(self, *args, **kwargs):
+        if _rendering.get():
+            return super().render(*args, **kwargs)
+        token = _rendering.set(True)
+        started_at = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            _rendering.reset(token)
+            template_render_duration.observe(elapsed, self.name)
+            stats = _request_stats.get()
+            if stats is not None:
+                stats.template_seconds += elapsed
+
+
+class MetricsMiddleware:
+    # plain ASGI middleware: streams responses through untouched and times
+    # the request until its last body chunk is sent
+    def __init__(self, app, slow_request_seconds: float = 0):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        stats = RequestStats(record_statements=bool(self.slow_request_seconds))
+        token = _request_stats.set(stats)
+        status = 500
+        started_at = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_stats.reset(token)
+            elapsed = time.perf_counter() - started_at
+            # the route template, not the path, keeps the number of series bounded
+            route = getattr(scope.get('route'), 'path', None) or 'unmatched'
+            request_duration.observe(elapsed, scope['method'], route, status)
+            request_db_queries.observe(stats.queries, route)
+            request_db_seconds.observe(stats.db_seconds, route)
+            if self.slow_request_seconds and elapsed >= self.slow_request_seconds:
+                self._log_slow_request(scope, route, status, elapsed, stats)
+
+    def _log_slow_request(self, scope, route: str, status: int, elapsed: float, stats: RequestStats):
+        statements = '\n'.join(
+            f'  {seconds * 1000:8.2f} ms  {" ".join(statement.split())[:500]}' for seconds, statement in stats.statements
+        )
+        logger.warning(
+            'Slow request %s %s (%s) %d: %.1f ms, %d queries in %.1f ms, templates %.1f ms\n%s',
+            scope['method'], scope['path'], route, status, elapsed * 1000,
+            stats.queries, stats.db_seconds * 1000, stats.template_seconds * 1000, statements,
+        )
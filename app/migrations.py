@@ -0,0 +1,107 @@
+from sqlalchemy import inspect, text
+from sqlalchemy.orm import Session
+from . import archive, crud, models, search, sharding
+from .database import engine
+
+
+# indexes dropped from the models, removed from databases created before that
+DROPPED_INDEXES = {
+    # content is searched through messages_fts, receiver_id and sender_id are
+    # prefixes of the keyset pagination indexes
+    'messages': ['ix_messages_content', 'ix_messages_receiver_id', 'ix_messages_sender_id'],
+}
+
+
+# tables derived from existing data, filled once when they are first created
+BACKFILLS = {
+    'inbox_summaries': crud.rebuild_inbox_summaries,
+}
+
+
+# tables stored in every message shard, the others live in the users database
+SHARD_TABLES = ['messages', 'archive_dictionaries', 'archived_messages', 'inbox_summaries', 'notification_events']
+
+
+def upgrade(bind, tables: list[str] | None = None):
+    metadata = models.Base.metadata
+    tables = [metadata.tables[name] for name in tables] if tables else metadata.sorted_tables
+    names = [table.name for table in tables]
+    missing = [name for name in BACKFILLS if name in names and not inspect(bind).has_table(name)]
+    if 'messages' in names:
+        add_autoincrement(bind)
+    metadata.create_all(bind=bind, tables=tables)
+    # likewise for columns added to a model later, they are all nullable
+    inspector = inspect(bind)
+    for table in tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        with bind.begin() as conn:
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(bind.dialect)}'))
+    # create_all skips existing tables together with their indexes, so indexes
+    # added to a model after its table was created are created here
+    for table in tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
+    inspector = inspect(bind)
+    for table, indexes in DROPPED_INDEXES.items():
+        if table not in names:
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table)}
+        with bind.begin() as conn:
+            for name in existing.intersection(indexes):
+                conn.execute(text(f'DROP INDEX {name}'))
+    search.create_search_index(bind, names)
+    if 'archived_messages' in names:
+        with Session(bind) as db:
+            archive.index_archived_messages(db)
+    for name in missing:
+        with Session(bind) as db:
+            BACKFILLS[name](db)
+
+
+def add_autoincrement(bind):
+    # messages tables created before ids were AUTOINCREMENT hand out the ids of
+    # their newest rows again once those rows are archived: the table is
+    # rebuilt with it, so ids come from sqlite_sequence and never go back
+    if bind.dialect.name != 'sqlite':
+        return
+    with bind.begin() as conn:
+        ddl = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages'")).scalar()
+        if ddl is None or 'AUTOINCREMENT' in ddl.upper():
+            return
+        inspector = inspect(conn)
+        existing = [column['name'] for column in inspector.get_columns('messages')]
+        # the indexes would keep their names on the renamed table
+        for index in inspector.get_indexes('messages'):
+            conn.execute(text(f"DROP INDEX {index['name']}"))
+        conn.execute(text('ALTER TABLE messages RENAME TO messages_old'))
+        models.Message.__table__.create(conn)
+        columns = ', '.join(name for name in existing if name in models.Message.__table__.c)
+        conn.execute(text(f'INSERT INTO messages ({columns}) SELECT {columns} FROM messages_old'))
+        conn.execute(text('DROP TABLE messages_old'))
+
+
+def seed_message_ids(shard: sharding.Shard, min_id: int = 0):
+    # AUTOINCREMENT continues from sqlite_sequence, start the shard at its own
+    # offset and past every id it used: archived messages keep theirs, and
+    # messages moved to other shards (min_id, see split_messages) too
+    if shard.engine.dialect.name != 'sqlite':
+        return
+    with shard.engine.begin() as conn:
+        used = conn.execute(text(
+            "SELECT max(coalesce((SELECT max(id) FROM messages), 0), coalesce((SELECT max(id) FROM archived_messages), 0))"
+        )).scalar()
+        first_id = max(shard.first_id, used, min_id)
+        seq = conn.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'messages'")).scalar()
+        if seq is None:
+            conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', :seq)"), {'seq': first_id})
+        elif seq < first_id:
+            conn.execute(text("UPDATE sqlite_sequence SET seq = :seq WHERE name = 'messages'"), {'seq': first_id})
+
+
+def upgrade_all():
+    upgrade(engine, [table.name for table in models.Base.metadata.sorted_tables if table.name not in SHARD_TABLES])
+    for shard in sharding.shards:
+        upgrade(shard.engine, SHARD_TABLES)
+        seed_message_ids(shard)
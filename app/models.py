@@ -1,4 +1,4 @@
-from sqlalchemy import desc, Boolean, Column, ForeignKey, Integer, String, DateTime
+from sqlalchemy import desc, Boolean, Column, ForeignKey, Index, Integer, LargeBinary, String, DateTime
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
@@ -25,6 +25,8 @@ class User(Base):
     hide_visitors_count = Column(Boolean, default=False)
     hide_last_seen = Column(Boolean, default=False)
     appear_in_search_results = Column(Boolean, default=True)
+    # media store name of the cropped picture (see media.py)
+    avatar = Column(String, nullable=True)
 
     @property
     def full_name(self):
@@ -37,9 +39,10 @@ class Message(Base):
     __tablename__ = 'messages'
 
     id = Column(Integer, primary_key=True)
-    content = Column(String, index=True)
-    sender_id = Column(Integer, ForeignKey('users.id'), index=True)
-    receiver_id = Column(Integer, ForeignKey('users.id'), index=True)
+    # searched through the messages_fts full-text index (see search.py)
+    content = Column(String)
+    sender_id = Column(Integer, ForeignKey('users.id'))
+    receiver_id = Column(Integer, ForeignKey('users.id'))
     sender = relationship('User', backref='sent_messages', foreign_keys=[sender_id])
     receiver = relationship('User', backref='received_messages', foreign_keys=[receiver_id])
     is_anonymous = Column(Boolean, default=True)
@@ -47,9 +50,80 @@ class Message(Base):
     is_featured = Column(Boolean, default=False)
     sent_at = Column(DateTime, server_default=func.now())
     is_seen = Column(Boolean, default=False)
+    # media store name of the attached image
+    image = Column(String, nullable=True)
+
+    # Keyset pagination indexes, one per listing: every page is a range scan
+    # on (filter columns, sent_at, id) no matter how deep the cursor is
+    __table_args__ = (
+        Index('ix_messages_receiver_sent_at', 'receiver_id', 'sent_at', 'id'),
+        Index('ix_messages_receiver_public_sent_at', 'receiver_id', 'is_public', 'sent_at', 'id'),
+        Index('ix_messages_receiver_featured_sent_at', 'receiver_id', 'is_featured', 'sent_at', 'id'),
+        Index('ix_messages_sender_sent_at', 'sender_id', 'sent_at', 'id'),
+        # ids are never reused, each message shard counts from its own offset
+        {'sqlite_autoincrement': True},
+    )
 
     # Default ordering
     # default_order = sent_at.desc()
     # __mapper_args__ = {
     #     "order_by": sent_at.desc(),
     # }
+
+
+# Cold storage for old messages (see archive.py): neither public nor featured,
+# content deflated with the shard's dictionary. Same ids as in `messages`,
+# with only the indexes the inbox and sent listings need.
+class ArchivedMessage(Base):
+    __tablename__ = 'archived_messages'
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    content = Column(LargeBinary)
+    dictionary_id = Column(Integer, ForeignKey('archive_dictionaries.id'))
+    sender_id = Column(Integer, ForeignKey('users.id'))
+    receiver_id = Column(Integer, ForeignKey('users.id'))
+    is_anonymous = Column(Boolean, default=True)
+    sent_at = Column(DateTime)
+    is_seen = Column(Boolean, default=False)
+    image = Column(String, nullable=True)
+
+    __table_args__ = (
+        Index('ix_archived_messages_receiver_sent_at', 'receiver_id', 'sent_at', 'id'),
+        Index('ix_archived_messages_sender_sent_at', 'sender_id', 'sent_at', 'id'),
+    )
+
+
+class ArchiveDictionary(Base):
+    __tablename__ = 'archive_dictionaries'
+
+    id = Column(Integer, primary_key=True)
+    data = Column(LargeBinary)
+    created_at = Column(DateTime, server_default=func.now())
+
+
+# Per-user inbox counters, kept up to date by crud when messages are created
+# or marked seen, so the unread badge and the seen-marking check never count
+# the messages table.
+class InboxSummary(Base):
+    __tablename__ = 'inbox_summaries'
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    unread_count = Column(Integer, default=0, nullable=False)
+    total_count = Column(Integer, default=0, nullable=False)
+    last_message_at = Column(DateTime, nullable=True)
+
+
+# Outbox of new message notifications (see notifications.py): a row per
+# message, written in the transaction creating it and deleted once a digest
+# counting it was delivered to its receiver.
+class NotificationEvent(Base):
+    __tablename__ = 'notification_events'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    message_id = Column(Integer)
+    created_at = Column(DateTime, server_default=func.now())
+
+    __table_args__ = (
+        Index('ix_notification_events_user', 'user_id', 'id'),
+    )
@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import logging
+import smtplib
+import threading
+from datetime import datetime
+from email.message import EmailMessage
+from typing import NamedTuple
+import anyio
+import orjson
+from sqlalchemy import bindparam, delete, func, insert, select
+from sqlalchemy.orm import Session
+from . import models, sharding
+from .config import get_settings
+from .database import ReadSessionLocal, run_db
+
+logger = logging.getLogger(__name__)
+
+
+# New message notifications. Creating a message adds a row to the
+# notification_events outbox of its shard in the same transaction, so no
+# notification is lost with the process. Every NOTIFICATION_INTERVAL seconds
+# the digest worker counts the pending events per receiver and delivers one
+# digest per receiver ("12 new messages") through the configured sink, then
+# deletes the events it counted: a burst of messages to a popular user is a
+# single delivery. Receivers who turned notifications off get nothing and
+# their events are dropped. Delivery is at least once, a digest is sent again
+# if the process dies before its events are deleted.
+#
+# Only one process should run the worker (the server with NOTIFICATION_SINK
+# set, or the command below):
+#
+#   python -m app.notifications
+
+
+class Digest(NamedTuple):
+    user_id: int
+    name: str
+    email: str
+    count: int
+    first_at: datetime
+    last_at: datetime
+
+    @property
+    def subject(self) -> str:
+        return f"{self.count} new message{'s' if self.count != 1 else ''}"
+
+    def text(self, base_url: str = '') -> str:
+        text = f'Hi {self.name},\n\nYou have {self.subject} on Whisper.\n'
+        if base_url:
+            text += f"\n{base_url.rstrip('/')}/profile/\n"
+        return text
+
+
+# Sinks deliver a batch of digests, blocking (they run in a worker thread).
+# A sink raises when nothing could be delivered, the events are kept and the
+# batch is sent again at the next run.
+class FileSink:
+    # JSON lines appended to a file, for development and tests
+    def __init__(self, path: str, base_url: str = ''):
+        self.path = path
+        self.base_url = base_url
+        self._lock = threading.Lock()
+
+    def send(self, digests: list[Digest]):
+        lines = b''.join(
+            orjson.dumps({**digest._asdict(), 'subject': digest.subject, 'text': digest.text(self.base_url)}) + b'\n'
+            for digest in digests
+        )
+        with self._lock, open(self.path, 'ab') as f:
+            f.write(lines)
+
+
+class SMTPSink:
+    # one connection per batch
+    def __init__(
+        self, host: str, port: int, sender: str, username: str = '', password: str = '',
+        starttls: bool = False, base_url: str = '', timeout: float = 30,
+    ):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.base_url = base_url
+        self.timeout = timeout
+
+    def send(self, digests: list[Digest]):
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            for digest in digests:
+                email = EmailMessage()
+                email['From'] = self.sender
+                email['To'] = digest.email
+                email['Subject'] = digest.subject
+                email.set_content(digest.text(self.base_url))
+                try:
+                    smtp.send_message(email)
+                except smtplib.SMTPRecipientsRefused:
+                    # a bad address doesn't hold back the others' digests
+                    logger.warning('Notification refused for user %d', digest.user_id)
+
+
+def make_sink(settings):
+    if settings.NOTIFICATION_SINK == 'file':
+        return FileSink(settings.NOTIFICATION_FILE, settings.NOTIFICATION_BASE_URL)
+    if settings.NOTIFICATION_SINK == 'smtp':
+        return SMTPSink(
+            settings.SMTP_HOST, settings.SMTP_PORT, settings.NOTIFICATION_FROM, settings.SMTP_USERNAME,
+            settings.SMTP_PASSWORD, settings.SMTP_STARTTLS, settings.NOTIFICATION_BASE_URL,
+        )
+    if settings.NOTIFICATION_SINK:
+        raise ValueError(f'Unknown NOTIFICATION_SINK {settings.NOTIFICATION_SINK!r}')
+    return None
+
+
+def add_events(db: Session, messages: list[models.Message]):
+    # called by crud in the transaction creating the messages
+    if not enabled:
+        return
+    events = [
+        {'user_id': m.receiver_id, 'message_id': m.id}
+        for m in messages if m.sender_id != m.receiver_id
+    ]
+    if events:
+        db.execute(insert(models.NotificationEvent), events)
+
+
+def pending_events(db: Session, after_user_id: int, limit: int) -> list:
+    """Pending events per receiver: user_id, count, last_id, first_at, last_at, by user_id."""
+    event = models.NotificationEvent
+    return db.execute(
+        select(
+            event.user_id, func.count().label('count'), func.max(event.id).label('last_id'),
+            func.min(event.created_at).label('first_at'), func.max(event.created_at).label('last_at'),
+        )
+        .where(event.user_id > after_user_id)
+        .group_by(event.user_id)
+        .order_by(event.user_id)
+        .limit(limit)
+    ).all()
+
+
+def get_recipients(db: Session, user_ids: list[int]) -> dict:
+    return {
+        user.id: user for user in db.execute(
+            select(models.User.id, models.User.name, models.User.email)
+            .where(models.User.id.in_(user_ids), models.User.allow_notifications == True)
+        )
+    }
+
+
+def delete_events(db: Session, counted: list[tuple[int, int]]):
+    # events added after the count are kept for the next digest
+    event = models.NotificationEvent.__table__
+    db.execute(
+        delete(event).where(event.c.user_id == bindparam('uid'), event.c.id <= bindparam('last_id')),
+        [{'uid': user_id, 'last_id': last_id} for user_id, last_id in counted],
+    )
+    db.commit()
+
+
+class DigestWorker:
+    def __init__(self, sink, batch_size: int):
+        self.sink = sink
+        self.batch_size = batch_size
+        self.digests = 0
+        self.events = 0
+        self.dropped_events = 0
+        self.failures = 0
+
+    async def _read(self, session_factory, func, *args):
+        with session_factory() as db:
+            return await run_db(func, db, *args)
+
+    async def send_digests(self) -> int:
+        """Deliver the pending events of every shard, returns the number of digests sent."""
+        sent = 0
+        for shard in sharding.shards:
+            after_user_id = 0
+            while True:
+                pending = await self._read(shard.ReadSessionLocal, pending_events, after_user_id, self.batch_size)
+                if not pending:
+                    break
+                after_user_id = pending[-1].user_id
+                recipients = await self._read(ReadSessionLocal, get_recipients, [row.user_id for row in pending])
+                digests = [
+                    Digest(row.user_id, recipients[row.user_id].name, recipients[row.user_id].email, row.count, row.first_at, row.last_at)
+                    for row in pending if row.user_id in recipients
+                ]
+                if digests:
+                    try:
+                        await anyio.to_thread.run_sync(self.sink.send, digests)
+                    except Exception:
+                        self.failures += 1
+                        raise
+                await shard.run_write(delete_events, [(row.user_id, row.last_id) for row in pending])
+                sent += len(digests)
+                self.digests += len(digests)
+                self.events += sum(row.count for row in pending)
+                self.dropped_events += sum(row.count for row in pending if row.user_id not in recipients)
+                if len(pending) < self.batch_size:
+                    break
+        return sent
+
+    async def run(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                sent = await self.send_digests()
+                if sent:
+                    logger.info('Sent %d notification digests', sent)
+            except Exception:
+                logger.exception('Failed to send notification digests')
+
+    def stats(self) -> dict:
+        return {
+            'digests': self.digests, 'events': self.events,
+            'dropped_events': self.dropped_events, 'failures': self.failures,
+        }
+
+
+_settings = get_settings()
+enabled = bool(_settings.NOTIFICATION_SINK)
+digest_worker = DigestWorker(make_sink(_settings), _settings.NOTIFICATION_BATCH_SIZE)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send the pending notification digests now.')
+    parser.parse_args()
+    if not enabled:
+        parser.error('NOTIFICATION_SINK is not set')
+    print(f'{asyncio.run(digest_worker.send_digests())} digests sent')
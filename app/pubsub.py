@@ -0,0 +1,44 @@
+import asyncio
+import logging
+from collections import defaultdict
+from .config import get_settings
+
+logger = logging.getLogger(__name__)
+
+
+# In-process pub/sub: one topic per receiver, one bounded queue per connected
+# client. Publishing never blocks, a client that stops reading loses
+# messages instead of holding memory (it refetches the inbox on reconnect).
+class Broker:
+    def __init__(self, queue_size: int):
+        self.queue_size = queue_size
+        self._topics = defaultdict(set)
+
+    def subscribe(self, topic) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._topics[topic].add(queue)
+        return queue
+
+    def unsubscribe(self, topic, queue: asyncio.Queue):
+        subscribers = self._topics.get(topic)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._topics[topic]
+
+    def has_subscribers(self, topic) -> bool:
+        return topic in self._topics
+
+    def publish(self, topic, payload) -> int:
+        delivered = 0
+        for queue in list(self._topics.get(topic, ())):
+            try:
+                queue.put_nowait(payload)
+                delivered += 1
+            except asyncio.QueueFull:
+                logger.warning('Dropping message for slow subscriber of %s', topic)
+        return delivered
+
+
+broker = Broker(get_settings().PUBSUB_QUEUE_SIZE)
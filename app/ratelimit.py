@@ -0,0 +1,109 @@
+import math
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from .config import get_settings
+from .exceptions import RateLimited, WritesBusy
+
+
+# Edge protection of the write path. Message posts are limited per client IP,
+# per receiver and per logged in sender with token buckets, and the write
+# routes have a global cap on requests in flight: excess requests are
+# answered at once (429 / 503) instead of queueing for the database writer.
+# Everything here is only touched from the event loop thread.
+#
+# Behind a reverse proxy, run uvicorn with --proxy-headers so the client IP
+# is the forwarded one.
+
+
+class TokenBuckets:
+    """Token buckets by key, refilled at `rate` tokens per second up to `burst`.
+
+    At most `maxsize` buckets are kept, the least recently used are dropped
+    (a dropped bucket comes back full). A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.allowed = 0
+        self.rejected = 0
+        self._buckets = OrderedDict()
+
+    def _tokens(self, key, now: float) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.burst
+        tokens, updated_at = bucket
+        return min(self.burst, tokens + (now - updated_at) * self.rate)
+
+    def wait_time(self, key, now: float, cost: float = 1) -> float:
+        """Seconds until `cost` tokens are available, 0 if they are now."""
+        if self.rate <= 0:
+            return 0.0
+        tokens = self._tokens(key, now)
+        return 0.0 if tokens >= cost else (cost - tokens) / self.rate
+
+    def take(self, key, now: float, cost: float = 1):
+        self.allowed += 1
+        if self.rate <= 0:
+            return
+        self._buckets[key] = (self._tokens(key, now) - cost, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'allowed': self.allowed, 'rejected': self.rejected, 'size': len(self._buckets)}
+
+
+def take_all(buckets: list[tuple[TokenBuckets, object]]):
+    """Take a token from every (buckets, key) pair, or none if one is empty."""
+    now = time.monotonic()
+    waits = [(b.wait_time(key, now), b) for b, key in buckets]
+    wait = max(w for w, _ in waits)
+    if wait:
+        for w, b in waits:
+            if w:
+                b.rejected += 1
+        raise RateLimited(math.ceil(wait))
+    for b, key in buckets:
+        b.take(key, now)
+
+
+class ConcurrencyLimit:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.rejected = 0
+
+    @contextmanager
+    def slot(self):
+        if self.in_flight >= self.limit:
+            self.rejected += 1
+            raise WritesBusy()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {'in_flight': self.in_flight, 'max_in_flight': self.max_in_flight, 'rejected': self.rejected}
+
+
+_settings = get_settings()
+messages_per_ip = TokenBuckets(_settings.MESSAGE_RATE_PER_IP, _settings.MESSAGE_BURST_PER_IP, _settings.RATE_LIMIT_TABLE_SIZE)
+messages_per_receiver = TokenBuckets(_settings.MESSAGE_RATE_PER_RECEIVER, _settings.MESSAGE_BURST_PER_RECEIVER, _settings.RATE_LIMIT_TABLE_SIZE)
+messages_per_sender = TokenBuckets(_settings.MESSAGE_RATE_PER_SENDER, _settings.MESSAGE_BURST_PER_SENDER, _settings.RATE_LIMIT_TABLE_SIZE)
+write_limit = ConcurrencyLimit(_settings.WRITE_CONCURRENCY)
+
+
+def limit_message(client_ip: str | None, receiver_id: int, sender_id: int | None):
+    buckets = [(messages_per_ip, client_ip), (messages_per_receiver, receiver_id)]
+    if sender_id is not None:
+        buckets.append((messages_per_sender, sender_id))
+    take_all(buckets)
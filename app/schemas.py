@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import Literal, NamedTuple
 from datetime import datetime
 from pydantic import BaseModel, validator, ValidationError
 
@@ -44,6 +44,17 @@ class User(UserInfo, PrivacySettings):
     class Config:
         orm_mode = True
 
+class UserSnapshot(User):
+    num_of_visitors: int | None = 0
+    avatar: str | None = None
+
+    @property
+    def full_name(self):
+        return self.name
+
+    class Config:
+        orm_mode = True
+
 class UserSearchResult(UserInfo):
     id: int
     joined_at: datetime
@@ -67,6 +78,7 @@ class SentMessage(MessageBase):
 
 class MessageCreate(MessageBase):
     sender_id: int | None
+    image: str | None = None
 
 
 class AnonymousMessage(MessageBase):
@@ -86,6 +98,46 @@ class Message(AnonymousMessage):
         orm_mode = True
 
 
+class MessageRow(NamedTuple):
+    id: int
+    content: str
+    sender_id: int | None
+    receiver_id: int
+    is_anonymous: bool
+    is_public: bool
+    is_featured: bool
+    is_seen: bool
+    sent_at: datetime
+    sender_name: str | None = None
+    receiver_name: str | None = None
+    image: str | None = None
+
+    @classmethod
+    def from_message(cls, message, sender_name: str | None = None, receiver_name: str | None = None):
+        return cls(
+            message.id, message.content,
+            None if message.is_anonymous else message.sender_id,
+            message.receiver_id, message.is_anonymous, message.is_public,
+            message.is_featured, message.is_seen, message.sent_at,
+            None if message.is_anonymous else sender_name, receiver_name, message.image,
+        )
+
+
+MAX_MODERATED_MESSAGES = 500
+
+class MessagesModeration(BaseModel):
+    action: Literal['publish', 'hide', 'feature', 'unfeature', 'delete']
+    ids: list[int]
+
+    @validator('ids', pre=True)
+    def validate_ids(cls, ids, **kwargs):
+        # htmx sends a single checked box as a scalar
+        ids = ids if isinstance(ids, list) else [ids]
+        if len(ids) > MAX_MODERATED_MESSAGES:
+            raise ValueError(f'At most {MAX_MODERATED_MESSAGES} messages at once')
+        return ids
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
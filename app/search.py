@@ -0,0 +1,126 @@
+from sqlalchemy import column, text
+from sqlalchemy.orm import Session
+from . import models
+
+
+# Full-text user search on an SQLite FTS5 table with the trigram tokenizer,
+# which answers case-insensitive substring queries from its index instead of
+# scanning `users` with LIKE '%q%'. Only users that appear in search results
+# are indexed, rowid is the user id.
+USERS_FTS_DDL = "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(name, email, tokenize='trigram')"
+
+# Inbox search uses the same approach over message contents. Each row also
+# carries a `<receiver_id>` token so a query is intersected with the
+# receiver's own messages inside the index. Replaces the B-tree index on
+# messages.content, which could not serve substring queries. Archived
+# messages keep their rows (rowid is the message id in both tables), their
+# deflated contents can't be searched otherwise. The index is contentless:
+# it holds no copy of the messages, and a row is deleted by giving the
+# values it was indexed with (see unindex_messages).
+MESSAGES_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, receiver, content='', tokenize='trigram')"
+)
+
+# trigram indexes can't answer shorter queries
+MIN_QUERY_LENGTH = 3
+
+
+def is_supported(bind) -> bool:
+    return bind.dialect.name == 'sqlite'
+
+
+def create_search_index(bind, tables: list[str]):
+    # each index lives next to its table, messages_fts in every message shard
+    if not is_supported(bind):
+        return
+    for table, name, ddl, rebuild in [
+        ('users', 'users_fts', USERS_FTS_DDL, rebuild_users_index),
+        ('messages', 'messages_fts', MESSAGES_FTS_DDL, rebuild_messages_index),
+    ]:
+        if table not in tables:
+            continue
+        with bind.begin() as conn:
+            current = conn.execute(text("SELECT sql FROM sqlite_master WHERE name = :name"), {'name': name}).scalar()
+            if current is not None and current != ddl.replace('IF NOT EXISTS ', ''):
+                # created with other options (messages_fts used to store contents)
+                conn.execute(text(f'DROP TABLE {name}'))
+                current = None
+            conn.execute(text(ddl))
+            if current is None:
+                rebuild(conn)
+
+
+def rebuild_users_index(conn):
+    conn.execute(text("DELETE FROM users_fts"))
+    conn.execute(text(
+        "INSERT INTO users_fts (rowid, name, email) "
+        "SELECT id, name, email FROM users WHERE appear_in_search_results"
+    ))
+
+
+def rebuild_messages_index(conn):
+    # archived messages are added back by archive.index_archived_messages
+    conn.execute(text("INSERT INTO messages_fts (messages_fts) VALUES ('delete-all')"))
+    conn.execute(text(
+        "INSERT INTO messages_fts (rowid, content, receiver) "
+        "SELECT id, content, '<' || receiver_id || '>' FROM messages"
+    ))
+
+
+def index_user(db: Session, user: models.User):
+    if not is_supported(db.get_bind()):
+        return
+    db.execute(text("DELETE FROM users_fts WHERE rowid = :id"), {'id': user.id})
+    if user.appear_in_search_results:
+        db.execute(
+            text("INSERT INTO users_fts (rowid, name, email) VALUES (:id, :name, :email)"),
+            {'id': user.id, 'name': user.name or '', 'email': user.email or ''}
+        )
+
+
+def search_user_ids(db: Session, q: str, skip: int, limit: int) -> list[int]:
+    params = {'skip': skip, 'limit': limit}
+    if len(q) >= MIN_QUERY_LENGTH:
+        # a quoted phrase is a plain substring query for the trigram tokenizer
+        params['q'] = '"' + q.replace('"', '""') + '"'
+        query = "SELECT rowid FROM users_fts WHERE users_fts MATCH :q ORDER BY rank LIMIT :limit OFFSET :skip"
+    else:
+        params['q'] = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        query = (
+            "SELECT rowid FROM users_fts WHERE name LIKE :q ESCAPE '\\' OR email LIKE :q ESCAPE '\\' "
+            "ORDER BY name LIMIT :limit OFFSET :skip"
+        )
+    return [row[0] for row in db.execute(text(query), params)]
+
+
+def index_messages(db: Session, messages: list[models.Message]):
+    if not is_supported(db.get_bind()) or not messages:
+        return
+    db.execute(
+        text("INSERT INTO messages_fts (rowid, content, receiver) VALUES (:id, :content, :receiver)"),
+        [{'id': m.id, 'content': m.content, 'receiver': f'<{m.receiver_id}>'} for m in messages]
+    )
+
+
+def unindex_messages(db: Session, messages: list):
+    # messages (or rows) with the id, content and receiver_id they were indexed with
+    if not is_supported(db.get_bind()) or not messages:
+        return
+    db.execute(
+        text("INSERT INTO messages_fts (messages_fts, rowid, content, receiver) VALUES ('delete', :id, :content, :receiver)"),
+        [{'id': m.id, 'content': m.content, 'receiver': f'<{m.receiver_id}>'} for m in messages]
+    )
+
+
+def is_indexed_query(db: Session, q: str) -> bool:
+    return is_supported(db.get_bind()) and len(q) >= MIN_QUERY_LENGTH
+
+
+def message_search_filter(db: Session, user_id: int, q: str, model=models.Message):
+    # model is Message or ArchivedMessage, the latter for indexed queries only
+    if is_indexed_query(db, q):
+        match = 'content : "{}" AND receiver : "<{}>"'.format(q.replace('"', '""'), user_id)
+        matching_ids = text("SELECT rowid FROM messages_fts WHERE messages_fts MATCH :match").bindparams(match=match)
+        return model.id.in_(matching_ids.columns(column('rowid')))
+    # too short for trigrams, scan the (already receiver-scoped) inbox
+    return models.Message.content.icontains(q, autoescape=True)
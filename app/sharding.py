@@ -0,0 +1,63 @@
+from contextlib import contextmanager
+from sqlalchemy.orm import Session, sessionmaker
+from . import database
+from .config import get_settings
+
+
+# Horizontal sharding of messages by receiver. Messages, their search index
+# and inbox summaries are spread over several SQLite databases by receiver_id
+# while users stay in DATABASE_URL. Each shard has its own writer connection,
+# so posts to different shards are no longer serialized on one file lock.
+# Inbox, public and favourite listings read a single shard, only the sent
+# view reads them all (see crud.get_sent_messages).
+# Message ids stay unique across shards, shard k hands out ids from
+# k << ID_BITS on (seeded by migrations).
+ID_BITS = 40
+
+
+class Shard:
+    def __init__(self, index: int, url: str):
+        self.index = index
+        self.url = url
+        if url == database.SQLALCHEMY_DATABASE_URL:
+            # the users database, sharing its engines keeps a single writer connection
+            self.engine, self.read_engine = database.engine, database.read_engine
+            self.SessionLocal, self.ReadSessionLocal = database.SessionLocal, database.ReadSessionLocal
+        else:
+            self.engine, self.read_engine = database.create_engines(url)
+            self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+            self.ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.read_engine)
+
+    @property
+    def first_id(self) -> int:
+        return self.index << ID_BITS
+
+    @contextmanager
+    def session(self, db: Session):
+        # the caller's session when it is already on this shard, else a read session
+        if db.get_bind() in (self.engine, self.read_engine):
+            yield db
+            return
+        with self.ReadSessionLocal() as shard_db:
+            yield shard_db
+
+    async def run_write(self, func, *args, **kwargs):
+        """Run `func(db, *args, **kwargs)` in a writer session of this shard."""
+        return await database.run_write_in(self.SessionLocal, func, *args, **kwargs)
+
+    def __repr__(self):
+        return f'<Shard {self.index} {self.url}>'
+
+
+shards = [
+    Shard(index, url)
+    for index, url in enumerate(get_settings().MESSAGE_SHARDS or [database.SQLALCHEMY_DATABASE_URL])
+]
+
+
+def for_user(user_id: int) -> Shard:
+    return shards[user_id % len(shards)]
+
+
+async def run_write(receiver_id: int, func, *args, **kwargs):
+    return await for_user(receiver_id).run_write(func, *args, **kwargs)
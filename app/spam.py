@@ -0,0 +1,268 @@
+import argparse
+import logging
+import os
+import pickle
+import re
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import String, literal, select
+from . import models, sharding
+from .config import get_settings
+from .exceptions import SpamDetected
+
+logger = logging.getLogger(__name__)
+
+
+# Near-duplicate detection of incoming messages. Each message is reduced to
+# a MinHash signature of its character shingles (one-permutation MinHash: a
+# single crc32 per shingle, the shingle goes to one of BINS bins which keep
+# their smallest hash), and the signatures of the most recent messages are
+# kept in an LSH index: a message is compared only to the ones sharing one
+# of its BANDS bands. A message is spam when near-duplicates of it were just
+# sent to the same receiver by the same sender (logged in user, or client IP
+# for anonymous messages), or to many receivers by anyone. Messages leave the
+# index after SPAM_WINDOW_SECONDS, or once SPAM_INDEX_SIZE newer ones came.
+#
+# The index lives in memory and is saved to SPAM_INDEX_PATH at shutdown. It
+# is rebuilt from the messages tables when that file is missing, or offline:
+#
+#   python -m app.spam
+
+SHINGLE_SIZE = 5
+BINS = 32
+BANDS = 8  # of BINS // BANDS bins each
+EMPTY_BIN = 0xFFFFFFFF
+# short notes ("hi :)", "I love you") are sent again and again in good faith,
+# they are never spam to their receiver, and too common to be judged across receivers
+MIN_RECEIVER_LENGTH = 16
+MIN_GLOBAL_LENGTH = 32
+# near-duplicates are counted up to the thresholds, large clusters keep their newest items
+MAX_BUCKET_SIZE = 64
+SNAPSHOT_VERSION = 2
+
+_non_word = re.compile(r'[\W_]+')
+
+
+def normalize(content: str) -> str:
+    return ' '.join(_non_word.sub(' ', content.casefold()).split())
+
+
+def signature(text: str) -> array:
+    signature = array('I', [EMPTY_BIN]) * BINS
+    if len(text) <= SHINGLE_SIZE:
+        shingles = [text]
+    else:
+        shingles = [text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)]
+    for shingle in shingles:
+        h = zlib.crc32(shingle.encode())
+        i = h % BINS
+        if h < signature[i]:
+            signature[i] = h
+    return signature
+
+
+def similarity(a: array, b: array) -> float:
+    # bins empty in both don't tell anything
+    used = same = 0
+    for x, y in zip(a, b):
+        if x != EMPTY_BIN or y != EMPTY_BIN:
+            used += 1
+            same += x == y
+    return same / used if used else 1.0
+
+
+def _band_keys(signature: array) -> list[int]:
+    # bands of empty bins only (short messages) would put them all in one bucket
+    rows = BINS // BANDS
+    keys = []
+    for band in range(BANDS):
+        values = signature[band * rows:(band + 1) * rows]
+        if values.count(EMPTY_BIN) < rows:
+            keys.append(hash((band, *values)))
+    return keys
+
+
+class SpamIndex:
+    def __init__(
+        self, size: int, window: float, action: str, threshold: float, receiver_duplicates: int, global_receivers: int,
+    ):
+        self.size = size
+        self.window = window
+        self.action = action
+        self.threshold = threshold
+        self.receiver_duplicates = receiver_duplicates
+        self.global_receivers = global_receivers
+        # item id -> (signature, receiver id, sender, added at, band keys), oldest first
+        self._items = OrderedDict()
+        # band key -> ids of the items with that band
+        self._buckets = {}
+        self._next_id = 0
+        # only touched from the event loop thread, or before serving
+        self.checked = 0
+        self.flagged = 0
+        self.check_seconds_total = 0.0
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, signature: array, receiver_id: int, sender=None, added_at: float | None = None):
+        keys = _band_keys(signature)
+        item_id = self._next_id
+        self._next_id += 1
+        self._items[item_id] = (signature, receiver_id, sender, time.time() if added_at is None else added_at, keys)
+        for key in keys:
+            bucket = self._buckets.setdefault(key, [])
+            if len(bucket) >= MAX_BUCKET_SIZE:
+                # oldest first
+                del bucket[0]
+            bucket.append(item_id)
+        while len(self._items) > self.size:
+            self._remove(*self._items.popitem(last=False))
+
+    def expire(self, now: float):
+        while self._items:
+            item_id, item = next(iter(self._items.items()))
+            if item[3] > now - self.window:
+                break
+            del self._items[item_id]
+            self._remove(item_id, item)
+
+    def _remove(self, item_id: int, item: tuple):
+        for key in item[4]:
+            bucket = self._buckets.get(key)
+            if bucket and item_id in bucket:
+                bucket.remove(item_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def duplicates(self, signature: array, receiver_id: int, sender=None) -> tuple[int, int]:
+        """Near-duplicates sent to receiver_id by sender and number of receivers of near-duplicates, both capped at the thresholds."""
+        candidates = set()
+        for key in _band_keys(signature):
+            candidates.update(self._buckets.get(key, ()))
+        same_receiver = 0
+        receivers = set()
+        for item_id in candidates:
+            other, other_receiver, other_sender, _, _ = self._items[item_id]
+            if similarity(signature, other) < self.threshold:
+                continue
+            receivers.add(other_receiver)
+            same_receiver += other_receiver == receiver_id and sender is not None and other_sender == sender
+            if same_receiver >= self.receiver_duplicates and len(receivers) >= self.global_receivers:
+                break
+        return same_receiver, len(receivers)
+
+    def check(self, content: str, receiver_id: int, sender=None):
+        """Raise SpamDetected for a near-duplicate flood (or log it, in flag mode), index the message otherwise.
+
+        sender is the logged in user's id, or the client IP of an anonymous message.
+        """
+        if self.action == 'off':
+            return
+        started_at = time.perf_counter()
+        self.expire(time.time())
+        text = normalize(content or '')
+        sig = signature(text)
+        same_receiver, receivers = self.duplicates(sig, receiver_id, sender)
+        spam = (len(text) >= MIN_RECEIVER_LENGTH and same_receiver >= self.receiver_duplicates) or (
+            len(text) >= MIN_GLOBAL_LENGTH and receivers >= self.global_receivers
+        )
+        self.checked += 1
+        if spam:
+            self.flagged += 1
+        # indexed before the message is written: concurrent copies see each other
+        if not spam or self.action == 'flag':
+            self.add(sig, receiver_id, sender)
+        self.check_seconds_total += time.perf_counter() - started_at
+        if spam:
+            if self.action == 'reject':
+                raise SpamDetected()
+            logger.warning('Near-duplicate message to user %d (%d to them, %d receivers)', receiver_id, same_receiver, receivers)
+
+    def stats(self) -> dict:
+        return {
+            'checked': self.checked, 'flagged': self.flagged, 'size': len(self._items),
+            'check_seconds_total': self.check_seconds_total,
+        }
+
+    def rebuild(self, db_sessions: list) -> int:
+        """Index the most recent messages of every shard (a session per shard).
+
+        Client IPs are not stored, anonymous messages are indexed without a sender.
+        """
+        since = datetime.now(timezone.utc) - timedelta(seconds=self.window)
+        rows = []
+        for db in db_sessions:
+            rows += db.execute(
+                select(models.Message.receiver_id, models.Message.sender_id, models.Message.content, models.Message.sent_at)
+                .where(models.Message.sent_at >= literal(since.strftime('%Y-%m-%d %H:%M:%S'), String))
+                .order_by(models.Message.id.desc())
+                .limit(self.size)
+            ).all()
+        rows.sort(key=lambda row: row.sent_at)
+        self._items.clear()
+        self._buckets.clear()
+        for row in rows[-self.size:]:
+            self.add(
+                signature(normalize(row.content or '')), row.receiver_id, row.sender_id,
+                row.sent_at.replace(tzinfo=timezone.utc).timestamp(),
+            )
+        return len(self._items)
+
+    def save(self, path: str):
+        items = [(sig.tobytes(), receiver_id, sender, added_at) for sig, receiver_id, sender, added_at, _ in self._items.values()]
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump({'version': SNAPSHOT_VERSION, 'bins': BINS, 'bands': BANDS, 'items': items}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+
+    def load(self, path: str) -> bool:
+        with open(path, 'rb') as f:
+            snapshot = pickle.load(f)
+        if (snapshot.get('version'), snapshot.get('bins'), snapshot.get('bands')) != (SNAPSHOT_VERSION, BINS, BANDS):
+            return False
+        self._items.clear()
+        self._buckets.clear()
+        for sig, receiver_id, sender, added_at in snapshot['items'][-self.size:]:
+            self.add(array('I', sig), receiver_id, sender, added_at)
+        self.expire(time.time())
+        return True
+
+
+def rebuild_from_database(index: SpamIndex) -> int:
+    sessions = [shard.ReadSessionLocal() for shard in sharding.shards]
+    try:
+        return index.rebuild(sessions)
+    finally:
+        for db in sessions:
+            db.close()
+
+
+def warm_up(index: SpamIndex, path: str | None):
+    # at startup, before requests are served
+    if path and os.path.exists(path):
+        try:
+            if index.load(path):
+                return
+        except Exception:
+            logger.exception('Failed to load the spam index from %s', path)
+    rebuild_from_database(index)
+
+
+_settings = get_settings()
+spam_index = SpamIndex(
+    _settings.SPAM_INDEX_SIZE, _settings.SPAM_WINDOW_SECONDS, _settings.SPAM_ACTION, _settings.SPAM_SIMILARITY,
+    _settings.SPAM_RECEIVER_DUPLICATES, _settings.SPAM_GLOBAL_RECEIVERS,
+)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the spam index from the messages tables.')
+    parser.add_argument('--output', default=_settings.SPAM_INDEX_PATH)
+    args = parser.parse_args()
+    count = rebuild_from_database(spam_index)
+    spam_index.save(args.output)
+    print(f'{count} messages indexed to {args.output}')
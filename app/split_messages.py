@@ -0,0 +1,84 @@
+import argparse
+from collections import Counter, defaultdict
+from sqlalchemy import column, delete, func, inspect, select, table
+from sqlalchemy.orm import Session
+from . import crud, database, migrations, models, search, sharding
+
+
+# Moves the messages of an existing database (db.sqlite by default) to the
+# shards configured in MESSAGE_SHARDS, keeping their ids. The search index and
+# inbox summaries of every database involved are rebuilt afterwards. Run it
+# with the app stopped:
+#
+#   MESSAGE_SHARDS='["sqlite:///./messages_0.sqlite", "sqlite:///./messages_1.sqlite"]' \
+#       python -m app.split_messages
+
+# untyped columns, rows are copied as stored (sent_at keeps its text format)
+messages = table('messages', *[column(c.name) for c in models.Message.__table__.columns])
+
+
+def split(source_url: str, chunk_size: int = 10000) -> Counter:
+    if source_url == database.SQLALCHEMY_DATABASE_URL:
+        source = database.engine
+    else:
+        source, _ = database.create_engines(source_url)
+    migrations.upgrade_all()
+    targets = [shard for shard in sharding.shards if shard.url != source_url]
+    if inspect(source).has_table('archived_messages'):
+        with source.connect() as conn:
+            # archived contents are deflated with a dictionary of their own database
+            if conn.execute(select(models.ArchivedMessage.id).limit(1)).first():
+                raise SystemExit('the source has archived messages, split it before archiving')
+    for shard in targets:
+        with shard.engine.connect() as conn:
+            if conn.execute(select(messages.c.id).limit(1)).first():
+                raise SystemExit(f'{shard} already has messages')
+
+    with source.connect() as conn:
+        last_id = conn.execute(select(func.max(messages.c.id))).scalar() or 0
+    # the source may predate columns added to messages since, they stay null
+    existing = {c['name'] for c in inspect(source).get_columns('messages')}
+    moved = Counter()
+    with source.connect() as conn:
+        rows = conn.execution_options(yield_per=chunk_size).execute(
+            select(*[c for c in messages.c if c.name in existing]).order_by(messages.c.id)
+        )
+        for chunk in rows.partitions():
+            by_shard = defaultdict(list)
+            for row in chunk:
+                shard = sharding.for_user(row.receiver_id)
+                if shard.url != source_url:
+                    by_shard[shard].append(row._asdict())
+            for shard, values in by_shard.items():
+                with shard.engine.begin() as shard_conn:
+                    shard_conn.execute(messages.insert(), values)
+                moved[shard.index] += len(values)
+
+    with source.begin() as conn:
+        for shard in targets:
+            conn.execute(delete(messages).where(messages.c.receiver_id % len(sharding.shards) == shard.index))
+
+    # moved messages keep their ids, no shard may hand them out again
+    # (shard 0 starts from 0, and the source may be one of the shards)
+    for shard in sharding.shards:
+        migrations.seed_message_ids(shard, last_id)
+
+    for bind in {source, *(shard.engine for shard in sharding.shards)}:
+        inspector = inspect(bind)
+        if search.is_supported(bind) and inspector.has_table('messages_fts'):
+            with bind.begin() as conn:
+                search.rebuild_messages_index(conn)
+        if inspector.has_table('inbox_summaries'):
+            with Session(bind) as db:
+                crud.rebuild_inbox_summaries(db)
+    return moved
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Move messages to the shards configured in MESSAGE_SHARDS.')
+    parser.add_argument('--source', default=database.SQLALCHEMY_DATABASE_URL, help='database holding the messages (default: DATABASE_URL)')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    args = parser.parse_args()
+    moved = split(args.source, args.chunk_size)
+    for shard in sharding.shards:
+        print(f'{shard}: {moved[shard.index]} messages moved')
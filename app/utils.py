@@ -1,4 +1,8 @@
+import base64
+import binascii
+from datetime import datetime
 from passlib.context import CryptContext
+from .exceptions import InvalidCursor
 
 
 
@@ -10,3 +14,33 @@ def verify_password(plain_password: str, hashed_password: str):
 
 def get_password_hash(password: str):
     return pwd_context.hash(password)
+
+
+# Keyset pagination cursors: an opaque, url-safe encoding of the (sent_at, id)
+# pair of the last row of a page.
+def encode_cursor(sent_at: datetime, id: int) -> str:
+    raw = f'{sent_at.isoformat()}|{id}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        sent_at, id = raw.split('|')
+        return datetime.fromisoformat(sent_at), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+
+def next_cursor(messages: list, limit: int) -> str | None:
+    if len(messages) < limit:
+        return None
+    last = messages[-1]
+    return encode_cursor(last.sent_at, last.id)
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match is "*" or a list of tags, compared weakly (W/ ignored)
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag.removeprefix('W/') == etag.removeprefix('W/'):
+            return True
+    return False
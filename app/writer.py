@@ -0,0 +1,100 @@
+import asyncio
+import time
+from collections import defaultdict
+from . import crud, schemas, sharding
+from .config import get_settings
+
+
+# Group commit for posted messages. Each request enqueues its message and
+# waits; a single writer task commits everything queued within a short
+# window as one transaction, so a burst of posts costs one fsync per batch
+# instead of one per message. Requests are acknowledged only after the
+# batch holding their message is committed.
+class MessageWriter:
+    def __init__(self, max_batch: int, max_delay: float):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = None
+        self.batches = 0
+        self.messages = 0
+        self.max_batch_size = 0
+        self.commit_seconds_total = 0.0
+        self.latency_seconds_total = 0.0
+        self.latency_seconds_max = 0.0
+
+    async def submit(self, message: schemas.MessageCreate):
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((message, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        self._queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._commit(batch)
+
+    async def stop(self):
+        # committed after everything already queued
+        await self._queue.put(None)
+
+    async def _commit(self, batch: list):
+        # one transaction per receiver shard, the shards commit in parallel
+        by_shard = defaultdict(list)
+        for item in batch:
+            by_shard[sharding.for_user(item[0].receiver_id)].append(item)
+        await asyncio.gather(*(self._commit_shard(shard, items) for shard, items in by_shard.items()))
+
+    async def _commit_shard(self, shard: sharding.Shard, batch: list):
+        started_at = time.perf_counter()
+        try:
+            messages = await shard.run_write(crud.create_messages, [message for message, _, _ in batch])
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        done_at = time.perf_counter()
+        self.batches += 1
+        self.messages += len(batch)
+        self.max_batch_size = max(self.max_batch_size, len(batch))
+        self.commit_seconds_total += done_at - started_at
+        for (_, future, queued_at), message in zip(batch, messages):
+            self.latency_seconds_total += done_at - queued_at
+            self.latency_seconds_max = max(self.latency_seconds_max, done_at - queued_at)
+            if not future.done():
+                future.set_result(message)
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'messages': self.messages,
+            'avg_batch_size': self.messages / self.batches if self.batches else 0,
+            'max_batch_size': self.max_batch_size,
+            'commit_seconds_total': self.commit_seconds_total,
+            'latency_seconds_total': self.latency_seconds_total,
+            'latency_seconds_max': self.latency_seconds_max,
+        }
+
+
+message_writer = MessageWriter(
+    get_settings().MESSAGE_GROUP_COMMIT_MAX_BATCH,
+    get_settings().MESSAGE_GROUP_COMMIT_MAX_DELAY,
+)
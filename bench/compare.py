@@ -0,0 +1,39 @@
+import argparse
+import json
+
+
+# Compares two bench.run reports route by route, e.g. before and after a change:
+#
+#   python -m bench.compare before.json after.json
+
+METRICS = ['throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms']
+
+
+def _change(before: float, after: float) -> str:
+    if not before:
+        return '     n/a'
+    return f'{(after - before) / before * 100:+7.1f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark reports.')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+    with open(args.before) as f:
+        before = json.load(f)
+    with open(args.after) as f:
+        after = json.load(f)
+
+    print(f"{'route':32} " + ' '.join(f'{metric:>26}' for metric in METRICS))
+    for route, results in after['routes'].items():
+        old = before['routes'].get(route)
+        if old is None:
+            continue
+        cells = [f'{old[m]:>8} -> {results[m]:>8} {_change(old[m], results[m])}' for m in METRICS]
+        errors = f"  errors {old['errors']} -> {results['errors']}" if old['errors'] or results['errors'] else ''
+        print(f'{route:32} ' + ' '.join(cells) + errors)
+
+
+if __name__ == '__main__':
+    main()
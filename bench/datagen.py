@@ -0,0 +1,157 @@
+import argparse
+import itertools
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+
+# Synthetic dataset for the benchmarks. The same seed and parameters always
+# produce the same data, dated relative to the time of the run. Inbox sizes follow a Zipf distribution (a few
+# popular users receive most messages), senders are either anonymous visitors
+# or random users.
+#
+#   python -m bench.datagen --db bench.sqlite --users 10000 --messages-per-user 50
+
+FIRST_NAMES = [
+    'Ahmad', 'Ali', 'Sam', 'Noha', 'Sara', 'Omar', 'Lina', 'Youssef', 'Mona', 'Karim',
+    'Hana', 'Adam', 'Laila', 'Ziad', 'Nour', 'Tarek', 'Yara', 'Hassan', 'Salma', 'Fadi',
+]
+LAST_NAMES = [
+    'Hassan', 'Ali', 'Wattson', 'Khalil', 'Mansour', 'Saleh', 'Nasser', 'Farouk', 'Haddad', 'Aziz',
+]
+WORDS = (
+    'you are the best friend anyone could ask for i always wanted to tell you that your smile '
+    'makes my day honestly sometimes you can be a bit too serious but we love you anyway thank '
+    'you for everything keep going never change hope we meet again soon miss our talks lately '
+    'why did you stop posting your drawings they were amazing good luck with the exams'
+).split()
+
+PASSWORD = 'pass123456'
+
+
+def email(user_id: int) -> str:
+    return f'user{user_id}@bench.test'
+
+
+def _content(rng: random.Random) -> str:
+    # mostly short messages, a long tail up to the 500 characters limit
+    length = min(int(rng.lognormvariate(2.5, 0.7)) + 1, 90)
+    return ' '.join(rng.choices(WORDS, k=length))[:500]
+
+
+def _sent_at(rng: random.Random, now: datetime, days: int) -> str:
+    # newer messages are more frequent, stored like CURRENT_TIMESTAMP
+    age = timedelta(seconds=int(days * 86400 * rng.random() ** 2))
+    return (now - age).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def generate(
+    users: int, messages_per_user: float, skew: float = 1.1, public_ratio: float = 0.2,
+    featured_ratio: float = 0.05, anonymous_ratio: float = 0.6, seen_ratio: float = 0.7,
+    days: int = 730, seed: int = 0, chunk_size: int = 10000,
+):
+    # imported here so that DATABASE_URL / MESSAGE_SHARDS can be set by the caller first
+    from sqlalchemy import column, table
+    from sqlalchemy.orm import Session
+    from app import crud, migrations, search, sharding, utils
+    from app.database import engine
+    from app.models import Message, User
+
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    migrations.upgrade_all()
+    # untyped columns, dates are written as the text CURRENT_TIMESTAMP produces
+    users_table, messages_table = [
+        table(model.__tablename__, *[column(c.name) for c in model.__table__.columns]) for model in (User, Message)
+    ]
+
+    # a single bcrypt hash for everyone, hashing each password would dominate the run
+    hashed_password = utils.get_password_hash(PASSWORD)
+    with engine.begin() as conn:
+        conn.execute(users_table.insert(), [
+            {
+                'id': user_id,
+                'name': f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                'email': email(user_id),
+                'bio': _content(rng) if rng.random() < 0.5 else None,
+                'gender': rng.choice('MF'),
+                'hashed_password': hashed_password,
+                'joined_at': _sent_at(rng, now, days),
+                'num_of_visitors': int(rng.paretovariate(1.5)) - 1,
+                'allow_new_messages': True,
+                'allow_sending_images': True,
+                'allow_anonymous_users_messages': True,
+                'allow_notifications': True,
+                'hide_visitors_count': rng.random() < 0.1,
+                'hide_last_seen': False,
+                'appear_in_search_results': rng.random() < 0.9,
+            }
+            for user_id in range(1, users + 1)
+        ])
+
+    # receivers drawn by Zipf rank, ranks shuffled over user ids
+    ranked = list(range(1, users + 1))
+    rng.shuffle(ranked)
+    cum_weights = list(itertools.accumulate(1 / rank ** skew for rank in range(1, users + 1)))
+    total = int(users * messages_per_user)
+    for start in range(0, total, chunk_size):
+        receivers = rng.choices(ranked, cum_weights=cum_weights, k=min(chunk_size, total - start))
+        rows = []
+        for receiver_id in receivers:
+            anonymous = rng.random() < anonymous_ratio
+            rows.append({
+                'content': _content(rng),
+                'sender_id': None if anonymous and rng.random() < 0.5 else rng.randint(1, users),
+                'receiver_id': receiver_id,
+                'is_anonymous': anonymous,
+                'is_public': rng.random() < public_ratio,
+                'is_featured': rng.random() < featured_ratio,
+                'sent_at': _sent_at(rng, now, days),
+                'is_seen': rng.random() < seen_ratio,
+            })
+        for shard, shard_rows in itertools.groupby(
+            sorted(rows, key=lambda row: sharding.for_user(row['receiver_id']).index),
+            key=lambda row: sharding.for_user(row['receiver_id']),
+        ):
+            with shard.engine.begin() as conn:
+                conn.execute(messages_table.insert(), list(shard_rows))
+
+    # derived tables, as after a migration
+    with engine.begin() as conn:
+        search.rebuild_users_index(conn)
+    for shard in sharding.shards:
+        with shard.engine.begin() as conn:
+            search.rebuild_messages_index(conn)
+        with Session(shard.engine) as db:
+            crud.rebuild_inbox_summaries(db)
+    return {'users': users, 'messages': total}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Whisper database.')
+    parser.add_argument('--db', default='bench.sqlite', help='SQLite file to create (must not exist)')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--messages-per-user', type=float, default=50, help='average inbox size')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the inbox sizes')
+    parser.add_argument('--public-ratio', type=float, default=0.2)
+    parser.add_argument('--featured-ratio', type=float, default=0.05)
+    parser.add_argument('--anonymous-ratio', type=float, default=0.6)
+    parser.add_argument('--seen-ratio', type=float, default=0.7)
+    parser.add_argument('--days', type=int, default=730, help='messages are spread over this many days')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if os.path.exists(args.db):
+        parser.error(f'{args.db} already exists')
+    os.environ['DATABASE_URL'] = f'sqlite:///{args.db}'
+
+    started_at = time.perf_counter()
+    counts = generate(
+        args.users, args.messages_per_user, args.skew, args.public_ratio, args.featured_ratio,
+        args.anonymous_ratio, args.seen_ratio, args.days, args.seed,
+    )
+    print(f"{counts['users']} users, {counts['messages']} messages in {time.perf_counter() - started_at:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
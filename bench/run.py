@@ -0,0 +1,194 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+from datetime import datetime, timezone
+import httpx
+from .datagen import PASSWORD, email
+
+
+# Load test of the main routes, either in-process against app.main.app through
+# httpx's ASGI transport (no network, measures the app itself) or against a
+# running server with --url. Each route is driven on its own by `concurrency`
+# closed-loop workers; the report has per route throughput and latency
+# percentiles and is written as JSON for bench.compare.
+#
+#   python -m bench.datagen --db bench.sqlite
+#   python -m bench.run --db bench.sqlite --output before.json
+#   python -m bench.run --url http://127.0.0.1:8000 --users 1000 --output before.json
+
+
+def _pick_user(rng: random.Random, users: int) -> int:
+    # profiles are visited and written to with the same kind of skew as the data
+    return min(int(rng.paretovariate(1.2)), users)
+
+
+# route name -> function(client, rng, users, sessions) building one request
+ROUTES = {
+    'POST /login': lambda client, rng, users, sessions: client.post(
+        '/login', data={'username': email(rng.randint(1, users)), 'password': PASSWORD},
+    ),
+    'GET /messages/': lambda client, rng, users, sessions: client.get(
+        '/messages/', headers=rng.choice(sessions),
+    ),
+    'GET /api/v1/messages/': lambda client, rng, users, sessions: client.get(
+        '/api/v1/messages/', headers=rng.choice(sessions),
+    ),
+    'GET /users/{id}': lambda client, rng, users, sessions: client.get(
+        f'/users/{_pick_user(rng, users)}',
+    ),
+    'GET /api/v1/users/?q=': lambda client, rng, users, sessions: client.get(
+        '/api/v1/users/', params={'q': rng.choice(['ah', 'ali', 'sam', 'noha', 'sara', 'omar', 'user1', 'khalil'])},
+    ),
+    'POST /users/{id}/messages/': lambda client, rng, users, sessions: client.post(
+        f'/users/{_pick_user(rng, users)}/messages/',
+        data={'content': 'benchmark message ' + str(rng.random())}, headers=rng.choice(sessions + [{}]),
+    ),
+}
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def _login(client: httpx.AsyncClient, user_id: int) -> dict:
+    response = await client.post(
+        '/login', data={'username': email(user_id), 'password': PASSWORD}, headers={'Accept': 'application/json'},
+    )
+    response.raise_for_status()
+    return {'Authorization': f"Bearer {response.json()['access_token']}"}
+
+
+async def run_route(client, name: str, requests: int, warmup: int, concurrency: int, users: int, sessions: list, seed: int) -> dict:
+    build = ROUTES[name]
+    rng = random.Random(seed)
+    latencies, errors = [], 0
+    remaining = warmup + requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            measured = remaining < requests
+            started_at = time.perf_counter()
+            try:
+                response = await build(client, rng, users, sessions)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+            if measured:
+                latencies.append(time.perf_counter() - started_at)
+                errors += failed
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        # includes the warmup requests, which ran with the same concurrency
+        'throughput_rps': round((warmup + requests) / elapsed, 1) if elapsed else 0.0,
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else 0.0,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1]) if latencies else 0.0,
+    }
+
+
+async def run(args, client: httpx.AsyncClient, users: int) -> dict:
+    # logged in once up front, only the POST /login route measures logins
+    sessions = [await _login(client, user_id) for user_id in range(1, min(args.sessions, users) + 1)]
+    results = {}
+    for offset, name in enumerate(args.routes):
+        results[name] = await run_route(
+            client, name, args.requests, args.warmup, args.concurrency, users, sessions, args.seed + offset,
+        )
+        print(f"{name:32} {results[name]['throughput_rps']:>9} req/s  p50 {results[name]['p50_ms']:>8} ms  "
+              f"p95 {results[name]['p95_ms']:>8} ms  p99 {results[name]['p99_ms']:>8} ms  errors {results[name]['errors']}")
+    return results
+
+
+async def run_in_process(args) -> tuple[dict, int]:
+    os.environ['DATABASE_URL'] = f'sqlite:///{args.db}'
+    # every request comes from the same client, the limits would only measure 429s
+    for limit in ('MESSAGE_RATE_PER_IP', 'MESSAGE_RATE_PER_RECEIVER', 'MESSAGE_RATE_PER_SENDER'):
+        os.environ.setdefault(limit, '0')
+    # and the posted messages are near-duplicates of each other
+    os.environ.setdefault('SPAM_ACTION', 'off')
+    from sqlalchemy import func, select
+    from app.database import engine
+    from app.main import app
+    from app.models import User
+
+    with engine.connect() as conn:
+        users = conn.execute(select(func.max(User.id))).scalar() or 0
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://bench') as client:
+            return await run(args, client, users), users
+
+
+async def run_remote(args) -> tuple[dict, int]:
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30) as client:
+        return await run(args, client, args.users), args.users
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the main Whisper routes.')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--db', default='bench.sqlite', help='database made by bench.datagen, served in-process')
+    target.add_argument('--url', help='base URL of a running server instead')
+    parser.add_argument('--users', type=int, default=1000, help='number of users in the served database (--url only)')
+    parser.add_argument('--routes', nargs='+', default=list(ROUTES), choices=list(ROUTES), metavar='ROUTE')
+    parser.add_argument('--requests', type=int, default=500, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=50, help='unmeasured requests per route')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--sessions', type=int, default=16, help='logged in users making the authenticated requests')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args()
+    if args.url is None and not os.path.exists(args.db):
+        parser.error(f'{args.db} not found, create it with python -m bench.datagen')
+
+    results, users = asyncio.run(run_remote(args) if args.url else run_in_process(args))
+    report = {
+        'meta': {
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'commit': _git_commit(),
+            'target': args.url or 'in-process',
+            'users': users,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'concurrency': args.concurrency,
+            'sessions': args.sessions,
+            'seed': args.seed,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'routes': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,13 @@
+// highlights the nav link of the current page
+const observeUrlChange = () => {
+  let url = document.location.href;
+  const pageName = url.split('?')[0].split('/').filter((e) => e).reverse()[0]
+  document.querySelectorAll('a.nav-link').forEach((link) => {
+    if (link.textContent.toLowerCase() == pageName) {
+      link.classList.add('active')
+    } else {
+      link.classList.remove('active')
+    }
+  })
+};
+window.onload = observeUrlChange;
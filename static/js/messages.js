@@ -0,0 +1,8 @@
+function copyLinkToClipboard() {
+    // Get the user link
+    const link = document.querySelector('#user-link').textContent
+    // Copy the text inside the text field
+    navigator.clipboard.writeText(link);
+    // Alert
+    alert("Your profile link has been copied to your clipboard");
+}
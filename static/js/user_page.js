@@ -0,0 +1,14 @@
+const messageContentTextArea = document.querySelector('#message-content')
+if (messageContentTextArea) {
+    const maxlength = Number(messageContentTextArea.getAttribute('maxlength'))
+    const ramainingLettersElement = document.querySelector('#remaining-letters')
+    if (ramainingLettersElement) {
+        ramainingLettersElement.textContent = maxlength.toString()
+    }
+    messageContentTextArea.addEventListener('input', function (event) {
+        const contentLength = messageContentTextArea.value.length
+        if (ramainingLettersElement) {
+            ramainingLettersElement.textContent = (maxlength - contentLength).toString()
+        }
+    })
+}